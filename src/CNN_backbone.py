@@ -127,9 +127,29 @@ class Backbone_VGG16(nn.Module):
         return out, feature
 
 
+class Backbone_MobileNetV3(nn.Module):
+    def __init__(self, num_classes=512):
+        super(Backbone_MobileNetV3, self).__init__()
+        self.backbone = backbone_.mobilenet_v3_large(pretrained=True).features
+        self.pool_method = nn.AdaptiveMaxPool2d(1)
+        self.output_layer = nn.Linear(960, num_classes)
+
+    def embedding(self, x):
+        y = self.backbone(x)
+        feature = self.pool_method(y).view(-1, 960)
+
+        return feature
+
+    def forward(self, x):
+        feature = self.embedding(x)
+        out = self.output_layer(feature)
+        return out, feature
+
+
 if __name__ == '__main__':
     model = Backbone_VGG16()
     # model = Backbone_Resnet50()
     # model = Backbone_Inception()
+    # model = Backbone_MobileNetV3()
     x = torch.randn((1, 3, 224, 224))
     y = model(x)
@@ -4,35 +4,30 @@ import torchvision
 import torchvision.transforms as transforms
 import numpy as np
 import os
-import glob
 from PIL import Image
 from tqdm import tqdm
 from torch.utils.data import Dataset, DataLoader
-from torchvision.transforms import Compose, Resize, ToTensor
+from gallery_index import get_gallery_features
+from dataset_index import load_dataset_index
+from image_cache import load_image_cache, open_image, eval_transform
+from retrieval import chunked_topk, encode_features, target_rank, topk_accuracy
+from ann_index import build_index
 
 
 class LoadDatasetSkt(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, transform):
-        skt_list = []
-        label_list = []
-        img_name_list = os.listdir(img_folder_path)
-
-        for img_name in img_name_list:
-            skt_list_path = glob.glob(skt_folder_path + img_name.split('.')[0] + '_*.png')
-            for skt_name in skt_list_path:
-                skt_name = skt_name.split('/')[-1].split('.')[0] + '.png'
-                img_item = img_name_list.index(img_name)
-                skt_list.append(skt_name)
-                label_list.append(img_item)
+    def __init__(self, img_folder_path, skt_folder_path, transform, cache_dir=None):
+        dataset_index = load_dataset_index(img_folder_path, skt_folder_path, skt_suffix='*')
 
         self.skt_folder_path = skt_folder_path
         self.transform = transform
-        self.skt_list = skt_list
-        self.label_list = label_list
+        self.skt_list = dataset_index.skt_list
+        self.label_list = dataset_index.skt_to_img.astype(np.int64)
+        self.skt_cache = None if cache_dir is None else load_image_cache(skt_folder_path, self.skt_list,
+                                                                         cache_dir)
 
     def __getitem__(self, item):
         skt_path = os.path.join(self.skt_folder_path, self.skt_list[item])
-        sample_skt = self.transform((Image.fromarray(np.array(Image.open(skt_path).convert('RGB')))))
+        sample_skt = self.transform(open_image(self.skt_folder_path, self.skt_list[item], self.skt_cache))
         image_idx = self.label_list[item]
 
         return sample_skt, image_idx, skt_path
@@ -42,14 +37,15 @@ class LoadDatasetSkt(Dataset):
 
 
 class LoadDatasetImg(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, transform):
+    def __init__(self, img_folder_path, skt_folder_path, transform, cache_dir=None):
         self.transform = transform
         self.img_folder_path = img_folder_path
-        self.img_list = os.listdir(img_folder_path)
+        self.img_list = load_dataset_index(img_folder_path, skt_folder_path, skt_suffix='*').img_list
+        self.img_cache = None if cache_dir is None else load_image_cache(img_folder_path, self.img_list,
+                                                                         cache_dir)
 
     def __getitem__(self, item):
-        img_path = os.path.join(self.img_folder_path, self.img_list[item])
-        sample_img = self.transform((Image.fromarray(np.array(Image.open(img_path).convert('RGB')))))
+        sample_img = self.transform(open_image(self.img_folder_path, self.img_list[item], self.img_cache))
 
         return sample_img
 
@@ -57,34 +53,30 @@ class LoadDatasetImg(Dataset):
         return len(self.img_list)
 
 
-def main_retrieval(skt_model, img_model, dataset='ChairV2', mode='test', device='cuda'):
+def main_retrieval(skt_model, img_model, dataset='ChairV2', mode='test', device='cuda', index_dir=None,
+                   ann_index=None):
     print('Evaluating Network dataset [{}_{}] ...'.format(dataset, mode))
 
     data_set_skt = LoadDatasetSkt(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform())
 
     data_set_img = LoadDatasetImg(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform())
 
     data_loader_skt = DataLoader(data_set_skt, batch_size=10, shuffle=True, num_workers=2, pin_memory=True)
-    data_loader_img = DataLoader(data_set_img, batch_size=128, shuffle=False, num_workers=2, pin_memory=True)
 
     skt_model = skt_model.to(device)
     img_model = img_model.to(device)
     skt_model.eval()
     img_model.eval()
 
-    img_list = os.listdir('./datasets/{}/{}B/'.format(dataset, mode))
-
     with torch.no_grad():
-        Image_Feature = torch.FloatTensor().to(device)
-        for imgs in tqdm(data_loader_img):
-            img = imgs.to(device)
-            img_feats, _ = img_model(img)
-            img_feats = F.normalize(img_feats, dim=1)
-            Image_Feature = torch.cat((Image_Feature, img_feats.detach()))
+        Image_Feature, img_list = get_gallery_features(img_model, data_set_img, batch_size=128,
+                                                       device=device, index_dir=index_dir)
+        if isinstance(ann_index, str):
+            ann_index = build_index(ann_index, Image_Feature, device=device)
 
         for idx, skts in enumerate(tqdm(data_loader_skt)):
             skt, skt_idx, target_sketch_paths = skts
@@ -92,7 +84,10 @@ def main_retrieval(skt_model, img_model, dataset='ChairV2', mode='test', device=
             skt_feats, _ = skt_model(skt)
             skt_feats = F.normalize(skt_feats, dim=1)
 
-            similarity_matrix = torch.argsort(torch.matmul(skt_feats, Image_Feature.T), dim=1, descending=True)
+            if ann_index is None:
+                _, similarity_matrix = chunked_topk(skt_feats, Image_Feature, k=10)
+            else:
+                _, similarity_matrix = ann_index.search(skt_feats, k=10)
             print('idx: ', idx)
             counts = similarity_matrix[:, 0] == skt_idx
             print(counts)
@@ -116,20 +111,21 @@ def main_retrieval(skt_model, img_model, dataset='ChairV2', mode='test', device=
             make_matrix(target_sketch_paths, pred_positions_lists, './SBIR_Chair/{}.png'.format(idx))
 
 
-def get_acc(skt_model, img_model, batch_size=128, dataset='ChairV2', mode='test', device='cuda'):
+def get_acc(skt_model, img_model, batch_size=128, dataset='ChairV2', mode='test', device='cuda',
+            index_dir=None, ann_index=None, image_cache_dir=None):
     print('Evaluating Network dataset [{}_{}] ...'.format(dataset, mode))
 
     data_set_skt = LoadDatasetSkt(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform(),
+                                  cache_dir=image_cache_dir)
 
     data_set_img = LoadDatasetImg(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform(),
+                                  cache_dir=image_cache_dir)
 
     data_loader_skt = DataLoader(data_set_skt, batch_size=batch_size,
-                                 shuffle=True, num_workers=2, pin_memory=True)
-    data_loader_img = DataLoader(data_set_img, batch_size=batch_size,
                                  shuffle=False, num_workers=2, pin_memory=True)
 
     skt_model = skt_model.to(device)
@@ -137,33 +133,24 @@ def get_acc(skt_model, img_model, batch_size=128, dataset='ChairV2', mode='test'
     skt_model.eval()
     img_model.eval()
 
-    top1_count = 0
-    top5_count = 0
-    top10_count = 0
-
     with torch.no_grad():
-        Image_Feature = torch.FloatTensor().to(device)
-        for imgs in tqdm(data_loader_img):
-            img = imgs.to(device)
-            img_feats, _ = img_model(img)
-            img_feats = F.normalize(img_feats, dim=1)
-            Image_Feature = torch.cat((Image_Feature, img_feats.detach()))
-
-        for idx, skts in enumerate(tqdm(data_loader_skt)):
-            skt, skt_idx = skts
-            skt, skt_idx = skt.to(device), skt_idx.to(device)
-            skt_feats, _ = skt_model(skt)
-            skt_feats = F.normalize(skt_feats, dim=1)
+        Image_Feature, _ = get_gallery_features(img_model, data_set_img, batch_size=batch_size,
+                                                device=device, index_dir=index_dir)
+        if isinstance(ann_index, str):
+            ann_index = build_index(ann_index, Image_Feature, device=device)
 
-            similarity_matrix = torch.argsort(torch.matmul(skt_feats, Image_Feature.T), dim=1, descending=True)
+        Sketch_Feature = encode_features(skt_model, data_loader_skt, device=device)
+        skt_idx = torch.tensor(data_set_skt.label_list, device=device)
 
-            top1_count += (similarity_matrix[:, 0] == skt_idx).sum()
-            top5_count += (similarity_matrix[:, :5] == torch.unsqueeze(skt_idx, dim=1)).sum()
-            top10_count += (similarity_matrix[:, :10] == torch.unsqueeze(skt_idx, dim=1)).sum()
+        if ann_index is None:
+            skt_rank = target_rank(Sketch_Feature, Image_Feature, skt_idx)
+        else:
+            # approximate search only returns the top 10, anything below counts as rank 10
+            _, pred_idx = ann_index.search(Sketch_Feature, k=10)
+            hits = pred_idx.to(device) == skt_idx.unsqueeze(1)
+            skt_rank = torch.where(hits.any(dim=1), hits.float().argmax(dim=1), 10)
 
-        top1_accuracy = round(top1_count.item() / len(data_set_skt) * 100, 3)
-        top5_accuracy = round(top5_count.item() / len(data_set_skt) * 100, 3)
-        top10_accuracy = round(top10_count.item() / len(data_set_skt) * 100, 3)
+        top1_accuracy, top5_accuracy, top10_accuracy = topk_accuracy(skt_rank, topk=(1, 5, 10))
 
     return top1_accuracy, top5_accuracy, top10_accuracy
 
@@ -209,7 +196,9 @@ if __name__ == "__main__":
     image_encoder.load_state_dict(checkpoint['img_model'])
 
     # Visualize  FG-SBIR results
-    main_retrieval(sketch_encoder, image_encoder, dataset='ChairV2', mode='test', device='cuda')
+    main_retrieval(sketch_encoder, image_encoder, dataset='ChairV2', mode='test', device='cuda',
+                   index_dir='./gallery_index')
 
     # Reference Model to test FG-SBIR results
-    get_acc(sketch_encoder, image_encoder, batch_size=128, dataset='ChairV2', mode='test', device='cuda')
+    get_acc(sketch_encoder, image_encoder, batch_size=128, dataset='ChairV2', mode='test', device='cuda',
+            index_dir='./gallery_index')
@@ -3,6 +3,7 @@ from timm.models.vision_transformer import VisionTransformer
 from timm.models.swin_transformer import SwinTransformer
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 # Swin-ViT
@@ -44,6 +45,10 @@ class EncoderViT(nn.Module):
         )
 
         # self.alpha = nn.Parameter(torch.tensor([1.]))
+        self.grad_checkpointing = False
+
+    def set_grad_checkpointing(self, enable=True):
+        self.grad_checkpointing = enable
 
     def embedding(self, image):
         x = self.encoder.patch_embed(image)
@@ -53,7 +58,12 @@ class EncoderViT(nn.Module):
         else:
             x = torch.cat((cls_token, self.encoder.dist_token.expand(x.shape[0], -1, -1), x), dim=1)
         x = self.encoder.pos_drop(x + self.encoder.pos_embed)
-        x = self.encoder.blocks(x)
+        if self.grad_checkpointing and torch.is_grad_enabled():
+            # keep only the block inputs, recompute each block in backward
+            for block in self.encoder.blocks:
+                x = checkpoint(block, x, use_reentrant=False)
+        else:
+            x = self.encoder.blocks(x)
         x = self.encoder.norm(x)
         return x
 
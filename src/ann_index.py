@@ -0,0 +1,273 @@
+"""
+Acknowledgements:
+1. https://github.com/facebookresearch/faiss/wiki/Faiss-indexes
+2. Jegou et al., Product Quantization for Nearest Neighbor Search, TPAMI 2011
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from retrieval import chunked_topk
+
+
+def as_tensor(feats, device='cpu'):
+    if isinstance(feats, np.ndarray):
+        feats = torch.from_numpy(np.ascontiguousarray(feats))
+    return feats.to(device=device, dtype=torch.float32)
+
+
+def assign_clusters(x, centroids, spherical=True, chunk_size=65536):
+    assign = torch.empty(len(x), dtype=torch.long, device=x.device)
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start:start + chunk_size]
+        if spherical:
+            assign[start:start + chunk_size] = torch.matmul(chunk, centroids.T).argmax(dim=1)
+        else:
+            distance = (centroids * centroids).sum(dim=1) - 2 * torch.matmul(chunk, centroids.T)
+            assign[start:start + chunk_size] = distance.argmin(dim=1)
+    return assign
+
+
+def kmeans(x, n_clusters, n_iter=20, spherical=True, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    n_clusters = min(n_clusters, len(x))
+    centroids = x[torch.randperm(len(x), generator=generator)[:n_clusters].to(x.device)].clone()
+
+    for _ in range(n_iter):
+        assign = assign_clusters(x, centroids, spherical)
+        counts = torch.bincount(assign, minlength=n_clusters)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+
+        # re-seed empty clusters from random points
+        empty = (counts == 0).nonzero().squeeze(1)
+        if len(empty) > 0:
+            centroids[empty] = x[torch.randint(len(x), (len(empty),), generator=generator).to(x.device)]
+        if spherical:
+            centroids = F.normalize(centroids, dim=1)
+
+    return centroids, assign_clusters(x, centroids, spherical)
+
+
+class ExactIndex:
+    kind = 'exact'
+
+    def __init__(self, device='cpu'):
+        self.device = device
+        self.feats = None
+
+    def build(self, feats):
+        self.feats = as_tensor(feats, self.device)
+        return self
+
+    def search(self, query_feats, k=10):
+        return chunked_topk(query_feats.to(self.device), self.feats, k=k)
+
+    def state(self):
+        return {'feats': self.feats.cpu().numpy()}
+
+    def load_state(self, state):
+        self.feats = as_tensor(state['feats'], self.device)
+        return self
+
+
+class IVFIndex:
+    # Inverted file over spherical k-means cells; search scans only the n_probe closest cells
+    kind = 'ivf'
+
+    def __init__(self, n_lists=256, n_probe=8, n_iter=20, device='cpu'):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.device = device
+        self.centroids = None
+        self.feats = None  # gallery features sorted by cell
+        self.ids = None  # original gallery id of each sorted row
+        self.offsets = None  # (n_lists + 1,) cell boundaries into feats / ids
+
+    def build(self, feats):
+        feats = as_tensor(feats, self.device)
+        self.centroids, assign = kmeans(feats, self.n_lists, n_iter=self.n_iter, spherical=True)
+
+        counts = torch.bincount(assign, minlength=len(self.centroids))
+        self.ids = torch.argsort(assign)
+        self.feats = feats[self.ids]
+        self.offsets = F.pad(torch.cumsum(counts, dim=0), (1, 0))
+        return self
+
+    def search(self, query_feats, k=10):
+        query_feats = query_feats.to(self.device, torch.float32)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probe = torch.matmul(query_feats, self.centroids.T).topk(n_probe, dim=1).indices  # (B, P)
+
+        # top-k per (query, probed cell), then merged across the probed cells
+        probe_scores = torch.full((len(query_feats), n_probe, k), float('-inf'), device=self.device)
+        probe_idx = torch.full((len(query_feats), n_probe, k), -1, dtype=torch.long, device=self.device)
+        offsets = self.offsets.tolist()
+        for cell in probe.unique().tolist():
+            start, end = offsets[cell], offsets[cell + 1]
+            if start == end:
+                continue
+            rows, slots = (probe == cell).nonzero(as_tuple=True)
+            scores, idx = torch.matmul(query_feats[rows], self.feats[start:end].T).topk(min(k, end - start), dim=1)
+            probe_scores[rows, slots, :scores.shape[1]] = scores
+            probe_idx[rows, slots, :scores.shape[1]] = self.ids[start:end][idx]
+
+        scores, order = probe_scores.flatten(1).topk(min(k, n_probe * k), dim=1)
+        return scores, torch.gather(probe_idx.flatten(1), 1, order)
+
+    def state(self):
+        return {'centroids': self.centroids.cpu().numpy(), 'feats': self.feats.cpu().numpy(),
+                'ids': self.ids.cpu().numpy(), 'offsets': self.offsets.cpu().numpy(),
+                'n_probe': np.array(self.n_probe)}
+
+    def load_state(self, state):
+        self.centroids = as_tensor(state['centroids'], self.device)
+        self.feats = as_tensor(state['feats'], self.device)
+        self.ids = torch.from_numpy(state['ids']).to(self.device)
+        self.offsets = torch.from_numpy(state['offsets']).to(self.device)
+        self.n_lists = len(self.centroids)
+        self.n_probe = int(state['n_probe'])
+        return self
+
+
+class PQIndex:
+    # Product quantization: each vector is stored as n_subspaces uint8 codes, scored by table lookup
+    kind = 'pq'
+
+    def __init__(self, n_subspaces=64, n_centroids=256, n_iter=20, n_train=65536, device='cpu'):
+        assert n_centroids <= 256, 'PQ codes are stored as uint8'
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.n_iter = n_iter
+        self.n_train = n_train
+        self.device = device
+        self.codebooks = None
+        self.codes = None
+
+    def build(self, feats):
+        feats = as_tensor(feats, self.device)
+        assert feats.shape[1] % self.n_subspaces == 0, 'feature dim must be divisible by n_subspaces'
+        sub_feats = feats.view(len(feats), self.n_subspaces, -1)
+        # codebooks are trained on a sample, then every item is encoded
+        train_idx = torch.randperm(len(feats), generator=torch.Generator().manual_seed(0))[:self.n_train]
+
+        codebooks, codes = [], []
+        for m in range(self.n_subspaces):
+            centroids, _ = kmeans(sub_feats[train_idx.to(feats.device), m].contiguous(), self.n_centroids,
+                                  n_iter=self.n_iter, spherical=False, seed=m)
+            centroids = F.pad(centroids, (0, 0, 0, self.n_centroids - len(centroids)))
+            codebooks.append(centroids)
+            codes.append(assign_clusters(sub_feats[:, m].contiguous(), centroids, spherical=False).to(torch.uint8))
+
+        self.codebooks = torch.stack(codebooks)  # (M, 256, D / M)
+        self.codes = torch.stack(codes, dim=1)  # (N, M)
+        return self
+
+    def decode(self, codes):
+        subspace = torch.arange(self.n_subspaces, device=self.device)
+        return self.codebooks[subspace, codes.long()].flatten(1)  # (C, D)
+
+    def search(self, query_feats, k=10, chunk_size=65536):
+        query_feats = query_feats.to(self.device, torch.float32)
+
+        top_scores, top_idx = None, None
+        for start in range(0, len(self.codes), chunk_size):
+            # decoding a chunk and using one matmul is much faster than per-code table gathers
+            scores = torch.matmul(query_feats, self.decode(self.codes[start:start + chunk_size]).T)  # (B, C)
+            scores, idx = scores.topk(min(k, scores.shape[1]), dim=1)
+            idx = idx + start
+
+            if top_scores is not None:
+                scores = torch.cat((top_scores, scores), dim=1)
+                idx = torch.cat((top_idx, idx), dim=1)
+                scores, order = scores.topk(min(k, scores.shape[1]), dim=1)
+                idx = torch.gather(idx, 1, order)
+            top_scores, top_idx = scores, idx
+
+        return top_scores, top_idx
+
+    def state(self):
+        return {'codebooks': self.codebooks.cpu().numpy(), 'codes': self.codes.cpu().numpy()}
+
+    def load_state(self, state):
+        self.codebooks = as_tensor(state['codebooks'], self.device)
+        self.codes = torch.from_numpy(state['codes']).to(self.device)
+        self.n_subspaces, self.n_centroids = self.codebooks.shape[:2]
+        return self
+
+
+ANN_INDEXES = {'exact': ExactIndex, 'ivf': IVFIndex, 'pq': PQIndex}
+
+
+def build_index(kind, feats, device='cpu', **kwargs):
+    return ANN_INDEXES[kind](device=device, **kwargs).build(feats)
+
+
+def save_index(index, path):
+    np.savez(path, kind=np.array(index.kind), **index.state())
+
+
+def load_index(path, device='cpu'):
+    state = np.load(path)
+    return ANN_INDEXES[str(state['kind'])](device=device).load_state(state)
+
+
+def recall_at_k(index, query_feats, gallery_feats, k=10):
+    # fraction of the exact top-k neighbours that the index also returns in its top-k
+    _, exact_idx = chunked_topk(query_feats, gallery_feats, k=k)
+    _, ann_idx = index.search(query_feats, k=k)
+    hits = (ann_idx.to(exact_idx.device).unsqueeze(2) == exact_idx.unsqueeze(1)).any(dim=1)
+    return hits.float().mean().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an ANN index over gallery features and report recall')
+    parser.add_argument('--features', type=str, default=None, help='gallery features.npy (random if not set)')
+    parser.add_argument('--num_gallery', type=int, default=100000, help='random gallery size')
+    parser.add_argument('--num_queries', type=int, default=1000, help='number of (held-out) queries')
+    parser.add_argument('--feature_dim', type=int, default=512, help='random feature dim')
+    parser.add_argument('--index', type=str, default='ivf', help='exact, ivf, pq')
+    parser.add_argument('--n_lists', type=int, default=256, help='IVF cells')
+    parser.add_argument('--n_probe', type=int, default=8, help='IVF cells scanned per query')
+    parser.add_argument('--n_subspaces', type=int, default=64, help='PQ subspaces')
+    parser.add_argument('--k', type=int, default=10, help='recall@k')
+    parser.add_argument('--save', type=str, default=None, help='save the index to this .npz path')
+    parser.add_argument('--device', type=str, default='cpu', help='index device')
+    args = parser.parse_args()
+
+    if args.features is not None:
+        gallery = as_tensor(np.load(args.features, mmap_mode='r'), args.device)
+    else:
+        # clustered random gallery, closer to real embeddings than isotropic noise
+        centers = torch.randn(args.num_gallery // 100 + 1, args.feature_dim, device=args.device)
+        gallery = centers[torch.randint(len(centers), (args.num_gallery,), device=args.device)]
+        gallery = F.normalize(gallery + 0.5 * torch.randn_like(gallery), dim=1)
+
+    # queries are perturbed gallery items, like sketches close to their photo
+    query_idx = torch.randint(len(gallery), (args.num_queries,), device=args.device)
+    queries = F.normalize(gallery[query_idx] + 0.05 * torch.randn_like(gallery[query_idx]), dim=1)
+
+    index_kwargs = {'ivf': {'n_lists': args.n_lists, 'n_probe': args.n_probe},
+                    'pq': {'n_subspaces': args.n_subspaces}}.get(args.index, {})
+
+    start = time.time()
+    index = build_index(args.index, gallery, device=args.device, **index_kwargs)
+    print('Build [{}] on {} items: {:.2f} s'.format(args.index, len(gallery), time.time() - start))
+
+    start = time.time()
+    chunked_topk(queries, gallery, k=args.k)
+    exact_time = time.time() - start
+    start = time.time()
+    index.search(queries, k=args.k)
+    ann_time = time.time() - start
+
+    print('Recall@{}: {:.4f}  |  Exact: {:.2f} ms/query  |  ANN: {:.2f} ms/query'.format(
+        args.k, recall_at_k(index, queries, gallery, k=args.k),
+        exact_time / len(queries) * 1000, ann_time / len(queries) * 1000))
+
+    if args.save is not None:
+        save_index(index, args.save)
@@ -0,0 +1,84 @@
+import queue
+import atexit
+import torch
+import torch.multiprocessing as mp
+
+
+def evaluate_splits(get_acc, skt_model, img_model, train_queries=None, **kwargs):
+    # (top1, top5, top10) on the test split and on the (optionally subsampled) train split
+    test_acc = get_acc(skt_model, img_model, mode='test', **kwargs)
+    train_acc = get_acc(skt_model, img_model, mode='train', num_queries=train_queries, **kwargs)
+    return test_acc, train_acc
+
+
+def snapshot(model):
+    return {name: tensor.detach().to('cpu', copy=True) for name, tensor in model.state_dict().items()}
+
+
+def eval_worker(model_fn, model_kwargs, get_acc, eval_kwargs, tasks, results):
+    # the models are built once, every task only loads new weights
+    skt_model = model_fn(**model_kwargs)
+    img_model = model_fn(**model_kwargs)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, skt_state, img_state = task
+        skt_model.load_state_dict(skt_state)
+        img_model.load_state_dict(img_state)
+        with torch.no_grad():
+            results.put((epoch, evaluate_splits(get_acc, skt_model, img_model, **eval_kwargs)))
+
+
+class AsyncEvaluator:
+    # Runs evaluate_splits on weight snapshots in a background process (on eval_kwargs['device']) while the
+    # next epochs train; the snapshots are kept here until their result arrives, for best-checkpoint saving
+    def __init__(self, model_fn, model_kwargs, get_acc, max_pending=1, **eval_kwargs):
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.max_pending = max_pending
+        self.pending = {}  # epoch -> (loss, (img_state, skt_state))
+        self.finished = []
+        # not a daemon: get_acc starts its own data loader workers
+        self.process = ctx.Process(target=eval_worker,
+                                   args=(model_fn, model_kwargs, get_acc, eval_kwargs, self.tasks, self.results))
+        self.process.start()
+        atexit.register(self.close)
+
+    def submit(self, epoch, loss, skt_model, img_model):
+        # bounded, so snapshots do not pile up when evaluation is slower than an epoch
+        while len(self.pending) >= self.max_pending:
+            self.finished += self.collect(wait=True, limit=1)
+
+        skt_state, img_state = snapshot(skt_model), snapshot(img_model)
+        self.pending[epoch] = (loss, (img_state, skt_state))
+        self.tasks.put((epoch, skt_state, img_state))
+
+    def collect(self, wait=False, limit=None):
+        finished = []
+        while self.pending and (limit is None or len(finished) < limit):
+            try:
+                epoch, accs = self.results.get(timeout=10) if wait else self.results.get_nowait()
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('Evaluation process exited with code {}'.format(self.process.exitcode))
+                if not wait:
+                    break
+                continue
+            loss, state = self.pending.pop(epoch)
+            finished.append((epoch, loss, accs, state))
+        return finished
+
+    def poll(self, wait=False):
+        # [(epoch, loss, (test_acc, train_acc), (img_state, skt_state)), ...] finished since the last poll,
+        # wait=True blocks until every submitted evaluation is done
+        finished = self.finished + self.collect(wait=wait)
+        self.finished = []
+        return finished
+
+    def close(self):
+        if self.process.is_alive():
+            self.tasks.put(None)
+            self.process.join()
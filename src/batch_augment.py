@@ -0,0 +1,44 @@
+import math
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+class BatchAugment(nn.Module):
+    # Batched counterpart of LoadMyDataset.transform_aug (Resize x1.2, RandomRotation, RandomHorizontalFlip,
+    # CenterCrop, Resize), composed into a single per-sample affine warp and run with one grid_sample
+    def __init__(self, im_size=224, scale=1.2, degrees=30, flip_p=0.8):
+        super().__init__()
+        self.im_size = im_size
+        self.scale = scale
+        self.degrees = degrees
+        self.flip_p = flip_p
+
+    def anchor(self, images):
+        # (B, 3, H, W) uint8 -> float in [0, 1] at im_size, like transform_anchor
+        images = images.float() / 255. if images.dtype == torch.uint8 else images
+        if images.shape[-2:] != (self.im_size, self.im_size):
+            images = F.interpolate(images, size=(self.im_size, self.im_size), mode='bilinear',
+                                   align_corners=False, antialias=True)
+        return images
+
+    def augment(self, images):
+        images = images.float() / 255. if images.dtype == torch.uint8 else images
+        batch_size = images.shape[0]
+
+        angle = (torch.rand(batch_size, device=images.device) * 2 - 1) * math.radians(self.degrees)
+        flip = torch.where(torch.rand(batch_size, device=images.device) < self.flip_p, -1., 1.)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # output coords -> centre crop (1 / scale) -> un-flip -> un-rotate, in normalized [-1, 1] coords
+        theta = torch.zeros((batch_size, 2, 3), device=images.device)
+        theta[:, 0, 0] = cos * flip / self.scale
+        theta[:, 0, 1] = -sin / self.scale
+        theta[:, 1, 0] = sin * flip / self.scale
+        theta[:, 1, 1] = cos / self.scale
+
+        grid = F.affine_grid(theta, [batch_size, images.shape[1], self.im_size, self.im_size], align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    def forward(self, images):
+        return self.anchor(images), self.augment(images)
@@ -1,51 +1,57 @@
 import os
-import glob
 import numpy as np
+import torch
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms
 
+from dataset_index import load_dataset_index
+from image_cache import load_image_cache, open_image
 
-class LoadMyDataset(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, im_size=224):
-        skt_list = []
-        img_list = []
-        img_name_list = os.listdir(img_folder_path)
-
-        for pos_img_name in img_name_list:
-            # 1.1 anchor_skt_name, pos_skt_name
-            pos_skt_list_path = glob.glob(skt_folder_path + pos_img_name.split('.')[0] + '_?.png')
-            pos_skt_list_name = [file_name.split('/')[-1].split('.')[0] + '.png'
-                                 for file_name in pos_skt_list_path]
 
-            # 1.2 append lists
-            if len(pos_skt_list_name) == 0:
-                print(pos_img_name)
+class LoadMyDataset(Dataset):
+    def __init__(self, img_folder_path, skt_folder_path, im_size=224, cache_dir=None, batch_aug=False):
+        dataset_index = load_dataset_index(img_folder_path, skt_folder_path)
 
-            for len_list in range(len(pos_skt_list_name)):
-                skt_list.append(pos_skt_list_name[len_list])
-                img_list.append(pos_img_name)
+        # 1.1 photos without any sketch
+        for img_idx in np.flatnonzero(np.bincount(dataset_index.skt_to_img,
+                                                  minlength=len(dataset_index.img_list)) == 0):
+            print(dataset_index.img_list[img_idx])
 
         self.img_folder_path = img_folder_path
         self.skt_folder_path = skt_folder_path
 
-        self.skt_list = skt_list
-        self.img_list = img_list
+        # 1.2 (anchor sketch, positive photo) pairs
+        self.skt_list = dataset_index.skt_list
+        self.img_list = [dataset_index.img_list[img_idx] for img_idx in dataset_index.skt_to_img]
+
+        # 1.3 decoded images at their original size, cached once; both views are resized from them
+        self.skt_cache = None
+        self.img_cache = None
+        if cache_dir is not None:
+            self.skt_cache = load_image_cache(skt_folder_path, self.skt_list, cache_dir)
+            self.img_cache = load_image_cache(img_folder_path, dataset_index.img_list, cache_dir)
 
         # A0
         self.transform_anchor = transforms.Compose([
-            transforms.Resize((im_size, im_size)),
-            transforms.ToTensor()
+            transforms.Resize((im_size, im_size), antialias=True),
+            transforms.ConvertImageDtype(torch.float)
+        ])
+
+        # uint8 anchors only, both views are then built on device by batch_augment.BatchAugment
+        self.batch_aug = batch_aug
+        self.transform_uint8 = transforms.Compose([
+            transforms.Resize((im_size, im_size), antialias=True)
         ])
 
         # A1
         self.transform_aug = transforms.Compose([
-            transforms.Resize((int(im_size * 1.2), int(im_size * 1.2))),
+            transforms.Resize((int(im_size * 1.2), int(im_size * 1.2)), antialias=True),
             transforms.RandomRotation(30),
             transforms.RandomHorizontalFlip(p=0.8),
             transforms.CenterCrop((int(im_size), int(im_size))),
-            transforms.Resize((im_size, im_size)),
-            transforms.ToTensor()
+            transforms.Resize((im_size, im_size), antialias=True),
+            transforms.ConvertImageDtype(torch.float)
         ])
 
         # A2
@@ -58,15 +64,19 @@ class LoadMyDataset(Dataset):
         # ])
 
     def __getitem__(self, item):
+        skt = open_image(self.skt_folder_path, self.skt_list[item], self.skt_cache)
+        img = open_image(self.img_folder_path, self.img_list[item], self.img_cache)
+
+        if self.batch_aug:
+            return self.transform_uint8(skt), self.transform_uint8(img)
+
         # 1.1 anchor skt
-        skt_path = os.path.join(self.skt_folder_path, self.skt_list[item])
-        skt_anchor = self.transform_anchor(Image.fromarray(np.array(Image.open(skt_path).convert('RGB'))))
-        skt_aug = self.transform_aug(Image.fromarray(np.array(Image.open(skt_path).convert('RGB'))))
+        skt_anchor = self.transform_anchor(skt)
+        skt_aug = self.transform_aug(skt)
 
         # 1.2 anchor img
-        pos_path = os.path.join(self.img_folder_path, self.img_list[item])
-        img_anchor = self.transform_anchor(Image.fromarray(np.array(Image.open(pos_path).convert('RGB'))))
-        img_aug = self.transform_aug(Image.fromarray(np.array(Image.open(pos_path).convert('RGB'))))
+        img_anchor = self.transform_anchor(img)
+        img_aug = self.transform_aug(img)
 
         sample = skt_anchor, skt_aug, img_anchor, img_aug
 
@@ -77,27 +87,18 @@ class LoadMyDataset(Dataset):
 
 
 class LoadDatasetSkt(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, transform):
-        skt_list = []
-        label_list = []
-        img_name_list = os.listdir(img_folder_path)
-
-        for img_name in img_name_list:
-            skt_list_path = glob.glob(skt_folder_path + img_name.split('.')[0] + '_?.png')
-            for skt_name in skt_list_path:
-                skt_name = skt_name.split('/')[-1].split('.')[0] + '.png'
-                img_item = img_name_list.index(img_name)
-                skt_list.append(skt_name)
-                label_list.append(img_item)
+    def __init__(self, img_folder_path, skt_folder_path, transform, cache_dir=None):
+        dataset_index = load_dataset_index(img_folder_path, skt_folder_path)
 
         self.skt_folder_path = skt_folder_path
         self.transform = transform
-        self.skt_list = skt_list
-        self.label_list = label_list
+        self.skt_list = dataset_index.skt_list
+        self.label_list = dataset_index.skt_to_img.astype(np.int64)
+        self.skt_cache = None if cache_dir is None else load_image_cache(skt_folder_path, self.skt_list,
+                                                                         cache_dir)
 
     def __getitem__(self, item):
-        skt_path = os.path.join(self.skt_folder_path, self.skt_list[item])
-        sample_skt = self.transform((Image.fromarray(np.array(Image.open(skt_path).convert('RGB')))))
+        sample_skt = self.transform(open_image(self.skt_folder_path, self.skt_list[item], self.skt_cache))
         image_idx = self.label_list[item]
 
         return sample_skt, image_idx
@@ -107,14 +108,15 @@ class LoadDatasetSkt(Dataset):
 
 
 class LoadDatasetImg(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, transform):
+    def __init__(self, img_folder_path, skt_folder_path, transform, cache_dir=None):
         self.transform = transform
         self.img_folder_path = img_folder_path
-        self.img_list = os.listdir(img_folder_path)
+        self.img_list = load_dataset_index(img_folder_path, skt_folder_path).img_list
+        self.img_cache = None if cache_dir is None else load_image_cache(img_folder_path, self.img_list,
+                                                                         cache_dir)
 
     def __getitem__(self, item):
-        img_path = os.path.join(self.img_folder_path, self.img_list[item])
-        sample_img = self.transform((Image.fromarray(np.array(Image.open(img_path).convert('RGB')))))
+        sample_img = self.transform(open_image(self.img_folder_path, self.img_list[item], self.img_cache))
 
         return sample_img
 
@@ -0,0 +1,70 @@
+import os
+import hashlib
+from collections import defaultdict, namedtuple
+import numpy as np
+
+from fingerprint import folder_fingerprint
+
+# img_list: photo names, skt_list: sketch names, skt_to_img: (num_sketches,) index into img_list
+DatasetIndex = namedtuple('DatasetIndex', ['img_list', 'skt_list', 'skt_to_img'])
+
+
+def scan_dataset(img_folder_path, skt_folder_path, skt_suffix='?', img_names=None, skt_names=None):
+    # One listing per folder; sketch xxxxx_<suffix>.png belongs to photo xxxxx.*, the same match as
+    # glob(skt_folder_path + 'xxxxx_?.png') (one character, data_loader.py) or 'xxxxx_*.png' (FG_SBIR.py)
+    img_list = sorted(os.listdir(img_folder_path)) if img_names is None else img_names
+    skt_names = sorted(os.listdir(skt_folder_path)) if skt_names is None else skt_names
+
+    skt_groups = defaultdict(list)
+    for skt_name in skt_names:
+        stem, ext = os.path.splitext(skt_name)
+        if ext != '.png':
+            continue
+        if skt_suffix == '?':
+            prefixes = [stem[:-2]] if len(stem) >= 2 and stem[-2] == '_' else []
+        else:
+            # '*' also matches underscores, so every underscore can end the photo name
+            prefixes = [stem[:idx] for idx, char in enumerate(stem) if char == '_']
+        for prefix in prefixes:
+            skt_groups[prefix].append(skt_name)
+
+    skt_list = []
+    skt_to_img = []
+    for img_idx, img_name in enumerate(img_list):
+        for skt_name in skt_groups.get(img_name.split('.')[0], []):
+            skt_list.append(skt_name)
+            skt_to_img.append(img_idx)
+
+    return DatasetIndex(img_list, skt_list, np.array(skt_to_img, dtype=np.int32))
+
+
+def load_dataset_index(img_folder_path, skt_folder_path, skt_suffix='?', cache_dir=None):
+    # The manifest is reused while the names, sizes and mtimes of the files in both folders are unchanged
+    # (replacing a file in place changes them too), so the sketch grouping is done once per dataset.
+    # It is kept next to the dataset root (e.g. ./datasets/ChairV2/.dataset_index/) unless cache_dir is given.
+    folders = [os.path.abspath(img_folder_path), os.path.abspath(skt_folder_path)]
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(folders[0]), '.dataset_index')
+    key = hashlib.sha1('\n'.join(folders + [skt_suffix]).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, key + '.npz')
+
+    img_names = sorted(os.listdir(img_folder_path))
+    skt_names = sorted(os.listdir(skt_folder_path))
+    fingerprint = folder_fingerprint(img_folder_path, img_names) + folder_fingerprint(skt_folder_path, skt_names)
+
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if str(cache['fingerprint']) == fingerprint:
+            return DatasetIndex(cache['img_list'].tolist(), cache['skt_list'].tolist(), cache['skt_to_img'])
+
+    dataset_index = scan_dataset(img_folder_path, skt_folder_path, skt_suffix, img_names, skt_names)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, '{}.{}.tmp.npz'.format(key, os.getpid()))
+    np.savez(tmp_path, fingerprint=np.array(fingerprint),
+             img_list=np.array(dataset_index.img_list, dtype=str),
+             skt_list=np.array(dataset_index.skt_list, dtype=str),
+             skt_to_img=dataset_index.skt_to_img)
+    os.replace(tmp_path, cache_path)
+
+    return dataset_index
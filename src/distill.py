@@ -0,0 +1,218 @@
+"""
+Acknowledgements:
+1. Hinton et al., Distilling the Knowledge in a Neural Network, NIPS 2014 Workshop
+2. Park et al., Relational Knowledge Distillation, CVPR 2019
+"""
+
+import os
+import random
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+import wandb
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from data_loader import LoadMyDataset
+from train_utils import get_acc
+from embed import load_encoder
+from precision import resolve_precision, autocast, make_scaler, StepTimer
+
+# student name -> (timm ViT, width), or None for the torchvision CNN
+STUDENTS = {'vit_tiny': ('vit_tiny_patch16_224', 192),
+            'vit_small': ('vit_small_patch16_224', 384),
+            'mobilenet_v3': None}
+
+
+def build_student(name, num_classes=512):
+    # small sketch encoder with the teacher's (mlp_feat, features) = model(image) interface
+    if STUDENTS[name] is None:
+        from CNN_backbone import Backbone_MobileNetV3
+        return Backbone_MobileNetV3(num_classes=num_classes)
+
+    from ViT_backbone import EncoderViT
+    encoder_backbone, feature_dim = STUDENTS[name]
+    return EncoderViT(num_classes=num_classes, feature_dim=feature_dim, encoder_backbone=encoder_backbone)
+
+
+def distill_loss(student_skt, teacher_skt, teacher_img, args):
+    # 1. embedding: the student sketch embedding points where the teacher's does (cosine)
+    student_skt = F.normalize(student_skt.float(), dim=1)
+    teacher_skt = F.normalize(teacher_skt.float(), dim=1)
+    teacher_img = F.normalize(teacher_img.float(), dim=1)
+    embed_loss = (1 - (student_skt * teacher_skt).sum(dim=1)).mean()
+
+    # 2. similarity structure: softened sketch -> photo similarities over the batch photos (embedded by the teacher),
+    # so the student stays compatible with the teacher's photo gallery
+    student_logits = torch.matmul(student_skt, teacher_img.T) / args.kd_temperature
+    teacher_logits = torch.matmul(teacher_skt, teacher_img.T) / args.kd_temperature
+    relation_loss = F.kl_div(F.log_softmax(student_logits, dim=1), F.softmax(teacher_logits, dim=1),
+                             reduction='batchmean') * args.kd_temperature ** 2
+
+    # 3. retrieval: InfoNCE of each sketch against its own photo among the batch photos,
+    # sketch i (and its other views at i + B, ...) belongs to photo i
+    labels = torch.arange(len(student_skt), device=student_skt.device) % len(teacher_img)
+    retrieval_loss = F.cross_entropy(torch.matmul(student_skt, teacher_img.T) / args.temperature, labels)
+
+    loss = embed_loss + args.relation_weight * relation_loss + args.retrieval_weight * retrieval_loss
+    return loss, (embed_loss, relation_loss, retrieval_loss)
+
+
+def distill_model(args):
+    if args.dataset == 'ClothesV1':
+        image_path_train = './datasets/ClothesV1/trainB/'
+        sketch_path_train = './datasets/ClothesV1/trainA/'
+        save_path = './checkpoint/ClothesV1_distill/'
+
+    elif args.dataset == 'ChairV2':
+        image_path_train = './datasets/ChairV2/trainB/'
+        sketch_path_train = './datasets/ChairV2/trainA/'
+        save_path = './checkpoint/ChairV2_distill/'
+
+    elif args.dataset == 'ShoeV2':
+        image_path_train = './datasets/ShoeV2/trainB/'
+        sketch_path_train = './datasets/ShoeV2/trainA/'
+        save_path = './checkpoint/ShoeV2_distill/'
+
+    else:
+        raise ValueError('Dataset Name Error !')
+
+    wandb.init(project='FGSBIR', config=args)
+    os.makedirs(save_path, exist_ok=True)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed_all(args.seed)
+
+    train_set = LoadMyDataset(img_folder_path=image_path_train, skt_folder_path=sketch_path_train,
+                              im_size=args.image_size, cache_dir=args.image_cache)
+    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
+                              pin_memory=True, drop_last=True)
+
+    # the photo side stays on the teacher, so existing gallery indices remain valid for the student
+    teacher_skt = load_encoder(args.teacher, modality='sketch', model=args.teacher_model, num_classes=args.num_classes,
+                               feature_dim=args.feature_dim, scales=args.scales, device=args.device)
+    teacher_img = load_encoder(args.teacher, modality='photo', model=args.teacher_model, num_classes=args.num_classes,
+                               feature_dim=args.feature_dim, scales=args.scales, device=args.device)
+    for param in list(teacher_skt.parameters()) + list(teacher_img.parameters()):
+        param.requires_grad = False
+
+    student = build_student(args.student, num_classes=args.num_classes).to(args.device)
+    print('Student [{}]: {:.1f} M params, teacher sketch encoder: {:.1f} M params'.format(
+        args.student, sum(p.numel() for p in student.parameters()) / 1e6,
+        sum(p.numel() for p in teacher_skt.parameters()) / 1e6))
+
+    args.precision = resolve_precision(args.precision, args.device)
+    scaler = make_scaler(args.precision, args.device)
+    optimizer = torch.optim.AdamW(student.parameters(), args.lr, weight_decay=args.weight_decay)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.num_epochs * len(train_loader))
+
+    for epoch in range(1, args.num_epochs + 1):
+        epoch_loss, epoch_embed_loss, epoch_relation_loss, epoch_retrieval_loss = 0, 0, 0, 0
+        student.train()
+        step_timer = StepTimer(args.device)
+
+        # 1.1 distillation: both sketch views go through the student, the anchor photo gives the teacher gallery
+        for skt_anchor, skt_aug, img_anchor, _ in tqdm(train_loader):
+            sketches = torch.cat((skt_anchor, skt_aug)).to(args.device, non_blocking=True)
+
+            with autocast(args.precision, args.device):
+                with torch.no_grad():
+                    teacher_skt_feat, _ = teacher_skt(sketches)
+                    teacher_img_feat, _ = teacher_img(img_anchor.to(args.device, non_blocking=True))
+                student_feat, _ = student(sketches)
+                loss, (embed_loss, relation_loss, retrieval_loss) = distill_loss(student_feat, teacher_skt_feat,
+                                                                                 teacher_img_feat, args)
+
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            step_timer.step(len(sketches))
+
+            epoch_loss = epoch_loss + loss.item()
+            epoch_embed_loss = epoch_embed_loss + embed_loss.item()
+            epoch_relation_loss = epoch_relation_loss + relation_loss.item()
+            epoch_retrieval_loss = epoch_retrieval_loss + retrieval_loss.item()
+
+        _, samples_per_second = step_timer.rates()
+        print('Epoch Distill: [{}] Loss: {}  |  {:.1f} samples/s'.format(epoch, epoch_loss, samples_per_second))
+        wandb.log({'Distill Loss': epoch_loss}, step=epoch)
+        wandb.log({'Embedding Loss': epoch_embed_loss}, step=epoch)
+        wandb.log({'Relation Loss': epoch_relation_loss}, step=epoch)
+        wandb.log({'Retrieval Loss': epoch_retrieval_loss}, step=epoch)
+        wandb.log({'Samples Per Second': samples_per_second}, step=epoch)
+
+        # 1.2 student sketches against the teacher photo gallery
+        if epoch % args.eval_every != 0 and epoch != args.num_epochs:
+            continue
+        student.eval()
+        with torch.no_grad():
+            top1_accuracy, top5_accuracy, top10_accuracy = get_acc(student, teacher_img, dataset=args.dataset,
+                                                                   device=args.device,
+                                                                   image_cache_dir=args.image_cache)
+        print('Epoch Test: [{}]'.format(epoch))
+        print('Top1: {:.3f} %  |  Top5: {:.3f} %  |  Top10: {:.3f} %'.format(top1_accuracy, top5_accuracy,
+                                                                             top10_accuracy))
+        wandb.log({'Top1 Acc': top1_accuracy}, step=epoch)
+        wandb.log({'Top5 Acc': top5_accuracy}, step=epoch)
+        wandb.log({'Top10 Acc': top10_accuracy}, step=epoch)
+
+        # 1.3 same checkpoint layout as train_main.py, 'student' tells embed.load_encoder how to build the sketch side
+        if (top1_accuracy > args.best_top1_acc) or \
+                (top1_accuracy == args.best_top1_acc and top10_accuracy > args.best_top10_acc):
+            args.best_top1_acc = top1_accuracy
+            args.best_top5_acc = top5_accuracy
+            args.best_top10_acc = top10_accuracy
+            save_state = {'img_model': teacher_img.state_dict(),
+                          'skt_model': student.state_dict(),
+                          'student': args.student,
+                          'teacher': os.path.abspath(args.teacher),
+                          'epoch': epoch,
+                          'loss': round(epoch_loss, 5),
+                          'top1': top1_accuracy,
+                          'top5': top5_accuracy,
+                          'top10': top10_accuracy}
+            print('Updating Network checkpoint [Best Acc]...')
+            torch.save(save_state, os.path.join(save_path, 'best_{}.pth'.format(args.student)))
+
+    print('Best Acc:\nTop1: {:.3f} %  |  Top5: {:.3f} %  |  Top10: {:.3f} %'.format(args.best_top1_acc,
+                                                                                    args.best_top5_acc,
+                                                                                    args.best_top10_acc))
+    wandb.finish()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distill a trained FGSBIR sketch encoder into a small student')
+    parser.add_argument('--teacher', type=str, required=True, help='train_main(_plus).py checkpoint')
+    parser.add_argument('--teacher_model', type=str, default='auto', help='auto, vit, plus')
+    parser.add_argument('--student', type=str, default='vit_tiny', help='vit_tiny, vit_small, mobilenet_v3')
+    parser.add_argument('--dataset', default='ChairV2', help='ClothesV1, ChairV2, ShoeV2')
+    parser.add_argument('--num_classes', type=int, default=512, help='embedding dim of teacher and student')
+    parser.add_argument('--feature_dim', type=int, default=768, help='teacher ViT width')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 7], help='teacher token recycling scales')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--batch_size', type=int, default=32, help='data loader batch size')
+    parser.add_argument('--num_workers', type=int, default=4, help='data loader num workers')
+    parser.add_argument('--num_epochs', type=int, default=100, help='distillation epochs')
+    parser.add_argument('--lr', type=float, default=1e-4, help='init learning rate')
+    parser.add_argument('--weight_decay', type=float, default=0.05, help='AdamW weight decay')
+    parser.add_argument('--temperature', type=float, default=0.07, help='retrieval InfoNCE temperature')
+    parser.add_argument('--kd_temperature', type=float, default=0.1, help='similarity distillation temperature')
+    parser.add_argument('--relation_weight', type=float, default=1.0, help='weight of the similarity structure term')
+    parser.add_argument('--retrieval_weight', type=float, default=0.5, help='weight of the InfoNCE term')
+    parser.add_argument('--best_top1_acc', type=float, default=0.0, help='the best Top1 acc')
+    parser.add_argument('--best_top5_acc', type=float, default=0.0, help='the best Top5 acc')
+    parser.add_argument('--best_top10_acc', type=float, default=0.0, help='the best Top10 acc')
+    parser.add_argument('--eval_every', type=int, default=1, help='evaluate every n epochs (and after the last)')
+    parser.add_argument('--image_cache', type=str, default=None, help='decoded image cache dir (e.g. ./image_cache)')
+    parser.add_argument('--precision', type=str, default='fp16', choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision (fp16 falls back to fp32 off CUDA)')
+    parser.add_argument('--device', type=str, default='cuda:0', help='training device')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    distill_model(args)
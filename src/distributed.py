@@ -0,0 +1,143 @@
+import os
+import builtins
+from datetime import timedelta
+import torch
+from torch import nn
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Subset
+
+from retrieval import encode_features
+
+
+def init_distributed(args):
+    # torchrun exports RANK, WORLD_SIZE and LOCAL_RANK, a plain `python` run stays single-process
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.distributed = args.world_size > 1
+    if not args.distributed:
+        return args
+
+    use_cuda = args.device.startswith('cuda') and torch.cuda.is_available()
+    if use_cuda:
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        torch.cuda.set_device(local_rank)
+        args.device = 'cuda:{}'.format(local_rank)
+    else:
+        args.device = 'cpu'
+
+    # rank 0 evaluates alone between epochs while the other ranks wait in the next collective
+    backend = args.dist_backend or ('nccl' if use_cuda else 'gloo')
+    dist.init_process_group(backend, timeout=timedelta(minutes=args.dist_timeout))
+    print('Distributed [{}] rank {} / {} on {}'.format(backend, args.rank, args.world_size, args.device))
+    setup_for_distributed(args.rank == 0)
+    return args
+
+
+def setup_for_distributed(is_master):
+    # only rank 0 prints, unless print(..., force=True)
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process():
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+class AllGather(torch.autograd.Function):
+    # Concatenates the features of every rank; the gradient of the local slice is summed over the ranks,
+    # since each rank computes the same global loss and DDP then averages
+    @staticmethod
+    def forward(ctx, features):
+        ctx.rank = dist.get_rank()
+        ctx.batch_size = len(features)
+        gathered = [torch.empty_like(features) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, features.contiguous())
+        return torch.cat(gathered, dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.contiguous()
+        dist.all_reduce(grad_output, op=dist.ReduceOp.SUM)
+        return grad_output[ctx.rank * ctx.batch_size:(ctx.rank + 1) * ctx.batch_size]
+
+
+def all_gather_features(features):
+    # every rank must pass the same batch size, which DistributedSampler guarantees
+    if get_world_size() == 1:
+        return features
+    if not features.requires_grad:
+        gathered = [torch.empty_like(features) for _ in range(get_world_size())]
+        dist.all_gather(gathered, features.contiguous())
+        return torch.cat(gathered, dim=0)
+    return AllGather.apply(features)
+
+
+def shard_slice(length):
+    # contiguous, balanced slice of [0, length) owned by this rank
+    rank, world_size = (dist.get_rank(), get_world_size()) if get_world_size() > 1 else (0, 1)
+    return slice(rank * length // world_size, (rank + 1) * length // world_size)
+
+
+def encode_sharded(model, dataset, batch_size=128, device='cuda', gather=True, num_workers=2):
+    # Each rank encodes its own slice of the dataset; with gather=True the slices are all-gathered back
+    # into dataset order, otherwise only the local (shard_slice) features are returned
+    assert len(dataset) >= get_world_size(), 'fewer samples than ranks'
+    shard = shard_slice(len(dataset))
+    data_loader = DataLoader(Subset(dataset, range(shard.start, shard.stop)), batch_size=batch_size,
+                             shuffle=False, num_workers=num_workers, pin_memory=True)
+    features = encode_features(model, data_loader, device=device)
+    if not gather or get_world_size() == 1:
+        return features
+
+    # all_gather needs equal shapes, so the slices (which differ by at most one) are padded
+    world_size = get_world_size()
+    sizes = [(rank + 1) * len(dataset) // world_size - rank * len(dataset) // world_size for rank in range(world_size)]
+    padded = features.new_zeros((max(sizes), features.shape[1]))
+    padded[:len(features)] = features
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    return torch.cat([feats[:size] for feats, size in zip(gathered, sizes)], dim=0)
+
+
+def reduce_topk_accuracy(rank, topk=(1, 5, 10)):
+    # top-k hit counts of the local queries, summed over the ranks
+    counts = torch.tensor([(rank < k).sum().item() for k in topk] + [len(rank)], dtype=torch.float64,
+                          device=rank.device)
+    if get_world_size() > 1:
+        dist.all_reduce(counts, op=dist.ReduceOp.SUM)
+    return tuple(round(hits / counts[-1].item() * 100, 3) for hits in counts[:-1].tolist())
+
+
+class StepModule(nn.Module):
+    # DDP only syncs gradients of work done inside its forward, and the training step calls embedding /
+    # mlp_head / head directly, so the per-step encode function is routed through this wrapper
+    def __init__(self, **models):
+        super().__init__()
+        self.models = nn.ModuleDict(models)
+
+    def forward(self, encode, *inputs):
+        return encode(*inputs)
+
+
+def wrap_ddp(args, **models):
+    step_module = StepModule(**models)
+    if not args.distributed:
+        return step_module
+    device_ids = [torch.device(args.device).index] if args.device.startswith('cuda') else None
+    # timm keeps its classifier head (and other parts) that the training step never calls
+    return nn.parallel.DistributedDataParallel(step_module, device_ids=device_ids, find_unused_parameters=True)
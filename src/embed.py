@@ -0,0 +1,176 @@
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from retrieval import encode_features
+from image_cache import read_image, eval_transform
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+STATE_KEYS = {'sketch': 'skt_model', 'photo': 'img_model'}
+
+
+def load_encoder(checkpoint_path, modality='sketch', model='auto', num_classes=512, feature_dim=768,
+                 scales=[1, 2, 7], device='cuda', allow_missing_encoders=False):
+    # Encoder of one modality from a train_main.py (vit) or train_main_plus.py (plus) checkpoint
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    state_dict = checkpoint[STATE_KEYS[modality]]
+    if model == 'auto':
+        model = 'plus' if any(key.startswith('recycle_model.') for key in state_dict) else 'vit'
+
+    if modality == 'sketch' and 'student' in checkpoint:
+        # distill.py checkpoint: a small sketch encoder next to the teacher photo encoder
+        from distill import build_student
+        model = checkpoint['student']
+        encoder = build_student(model, num_classes=num_classes)
+    elif model == 'plus':
+        from train_plus_utils import EncoderViT as EncoderViTPlus
+        encoder = EncoderViTPlus(num_classes=num_classes, feature_dim=feature_dim, scales=scales)
+        # plus checkpoints of the original code have no MSTR encoder weights
+        encoder.recycle_model.allow_missing_encoders = allow_missing_encoders
+    else:
+        from ViT_backbone import EncoderViT
+        encoder = EncoderViT(num_classes=num_classes, feature_dim=feature_dim, encoder_backbone='vit_base_patch16_224')
+
+    encoder.load_state_dict(state_dict)
+    print('Loaded [{}] {} encoder from {} (epoch {})'.format(model, modality, checkpoint_path,
+                                                           checkpoint.get('epoch')))
+    return encoder.to(device).eval()
+
+
+def list_images(input_path):
+    # a directory (searched recursively, sorted) or a text file with one image path per line
+    if os.path.isdir(input_path):
+        paths = []
+        for root, _, files in os.walk(input_path):
+            paths += [os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS)]
+        return sorted(paths)
+
+    with open(input_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class LoadImageList(Dataset):
+    def __init__(self, paths, im_size=224):
+        self.paths = paths
+        self.transform = eval_transform(im_size)
+
+    def __getitem__(self, item):
+        return self.transform(read_image(self.paths[item])), item
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def save_shard(features, ids, shard_path, output_format='npy'):
+    # features first, ids last: a shard counts as done once its .json exists
+    if output_format == 'safetensors':
+        from safetensors.numpy import save_file
+        save_file({'features': features}, shard_path + '.safetensors.tmp')
+        os.replace(shard_path + '.safetensors.tmp', shard_path + '.safetensors')
+    else:
+        with open(shard_path + '.npy.tmp', 'wb') as f:
+            np.save(f, features)
+        os.replace(shard_path + '.npy.tmp', shard_path + '.npy')
+
+    with open(shard_path + '.json.tmp', 'w') as f:
+        json.dump(ids, f)
+    os.replace(shard_path + '.json.tmp', shard_path + '.json')
+
+
+def embed_images(encoder, paths, output_dir, shard_size=100000, batch_size=128, num_workers=4, im_size=224,
+                 output_format='npy', device='cuda', config=None):
+    # Items are split into fixed shards in list order, finished shards are skipped, so an interrupted run
+    # is resumed by starting it again with the same arguments
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    manifest = {'config': dict(config or {}, shard_size=shard_size, format=output_format), 'num_items': len(paths),
+                'shards': []}
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous['config'] != manifest['config'] or previous['num_items'] != manifest['num_items']:
+            raise ValueError('{} holds embeddings of a different run, use another output dir'.format(output_dir))
+
+    for shard_idx, start in enumerate(range(0, len(paths), shard_size)):
+        shard_name = 'shard_{:05d}'.format(shard_idx)
+        shard_path = os.path.join(output_dir, shard_name)
+        shard_paths = paths[start:start + shard_size]
+        manifest['shards'].append({'name': shard_name, 'start': start, 'count': len(shard_paths)})
+
+        if os.path.exists(shard_path + '.json'):
+            print('Skipping finished {} ...'.format(shard_name))
+            continue
+
+        print('Embedding {} [{} - {}) ...'.format(shard_name, start, start + len(shard_paths)))
+        data_loader = DataLoader(LoadImageList(shard_paths, im_size=im_size), batch_size=batch_size,
+                                 shuffle=False, num_workers=num_workers, pin_memory=True)
+        with torch.no_grad():
+            features = encode_features(encoder, data_loader, device=device)
+        save_shard(features.float().cpu().numpy(), shard_paths, shard_path, output_format)
+
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def load_embeddings(output_dir):
+    # (N, D) features and their ids, concatenated over the shards of a finished run
+    with open(os.path.join(output_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    features, ids = [], []
+    for shard in manifest['shards']:
+        shard_path = os.path.join(output_dir, shard['name'])
+        if manifest['config']['format'] == 'safetensors':
+            from safetensors.numpy import load_file
+            features.append(load_file(shard_path + '.safetensors')['features'])
+        else:
+            features.append(np.load(shard_path + '.npy', mmap_mode='r'))
+        with open(shard_path + '.json') as f:
+            ids += json.load(f)
+
+    return np.concatenate(features), ids
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract sketch / photo embeddings into sharded feature files')
+    parser.add_argument('--checkpoint', type=str, required=True, help='train_main(_plus).py checkpoint')
+    parser.add_argument('--modality', type=str, default='photo', help='sketch, photo')
+    parser.add_argument('--input', type=str, required=True, help='image dir or text file of image paths')
+    parser.add_argument('--output', type=str, required=True, help='output dir of shards and manifest.json')
+    parser.add_argument('--model', type=str, default='auto', help='auto, vit, plus')
+    parser.add_argument('--num_classes', type=int, default=512, help='num classes')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ouput feature dim')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 7], help='token recycling scales')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--shard_size', type=int, default=100000, help='images per output shard')
+    parser.add_argument('--batch_size', type=int, default=128, help='data loader batch size')
+    parser.add_argument('--num_workers', type=int, default=4, help='data loader num workers')
+    parser.add_argument('--format', type=str, default='npy', help='npy, safetensors')
+    parser.add_argument('--num_parts', type=int, default=1, help='split the input list over this many jobs')
+    parser.add_argument('--part', type=int, default=0, help='index of the part this job embeds')
+    parser.add_argument('--device', type=str, default='cuda', help='device')
+    args = parser.parse_args()
+
+    image_paths = list_images(args.input)
+    # contiguous parts, each job writes its own output dir
+    part_start = args.part * len(image_paths) // args.num_parts
+    part_end = (args.part + 1) * len(image_paths) // args.num_parts
+    output_dir = args.output if args.num_parts == 1 else os.path.join(args.output, 'part_{:03d}'.format(args.part))
+
+    encoder = load_encoder(args.checkpoint, modality=args.modality, model=args.model, num_classes=args.num_classes,
+                           feature_dim=args.feature_dim, scales=args.scales, device=args.device)
+    embed_images(encoder, image_paths[part_start:part_end], output_dir, shard_size=args.shard_size,
+                 batch_size=args.batch_size, num_workers=args.num_workers, im_size=args.image_size,
+                 output_format=args.format, device=args.device,
+                 config={'checkpoint': os.path.abspath(args.checkpoint), 'modality': args.modality,
+                         'input': os.path.abspath(args.input), 'part': [args.part, args.num_parts]})
@@ -0,0 +1,117 @@
+"""
+Acknowledgements:
+1. https://pytorch.org/docs/stable/onnx.html
+2. https://onnxruntime.ai/docs/api/python/api_summary.html
+"""
+
+import os
+import time
+import argparse
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from embed import load_encoder
+
+
+class EmbeddingModel(nn.Module):
+    # Export surface of an encoder: image (B, 3, H, W) -> L2-normalized retrieval embedding (B, num_classes),
+    # the same features encode_features puts in the gallery
+    def __init__(self, encoder, normalize=True):
+        super().__init__()
+        self.encoder = encoder
+        self.normalize = normalize
+        recycle_model = getattr(encoder, 'recycle_model', None)
+        if recycle_model is not None:
+            # CUDA streams do not trace, the per-scale encoders are exported sequentially
+            recycle_model.concurrent = False
+
+    def forward(self, image):
+        embedding = self.encoder(image)[0]
+        return F.normalize(embedding, dim=1) if self.normalize else embedding
+
+
+def export_torchscript(model, example_images, path):
+    # traced, so the batch size stays symbolic (shape ops are recorded, not constants)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_images, check_trace=False)
+    torch.jit.save(traced, path)
+    return torch.jit.load(path)
+
+
+def export_onnx(model, example_images, path, opset=18):
+    # torch.export based exporter (needs onnxscript): the plus recycling encoders attend over dim 0
+    # (batch_first=False), which the TorchScript based exporter bakes into constant reshapes
+    with torch.no_grad():
+        torch.onnx.export(model, (example_images,), path, input_names=['image'], output_names=['embedding'],
+                          dynamic_shapes={'image': {0: torch.export.Dim('batch', min=1, max=4096)}},
+                          opset_version=opset, dynamo=True)
+
+    try:
+        import onnxruntime
+    except ImportError:
+        print('onnxruntime not installed, skipping the ONNX parity check')
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    return lambda images: torch.from_numpy(session.run(None, {'image': images.numpy()})[0])
+
+
+def check_parity(model, runtime, batch_sizes=[1, 8, 32], im_size=224, atol=1e-4, iters=10):
+    # max abs difference to eager on random inputs and mean latency (ms), per batch size
+    results = []
+    for batch_size in batch_sizes:
+        images = torch.rand(batch_size, 3, im_size, im_size)
+        with torch.no_grad():
+            reference = model(images)
+            exported = runtime(images)
+            diff = (reference - exported).abs().max().item()
+
+            start = time.perf_counter()
+            for _ in range(iters):
+                runtime(images)
+            latency = (time.perf_counter() - start) / iters * 1000
+
+        assert diff <= atol, 'batch {}: max abs diff {:.2e} > {:.0e}'.format(batch_size, diff, atol)
+        results.append((batch_size, diff, latency))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the sketch / photo encoders to ONNX and TorchScript')
+    parser.add_argument('--checkpoint', type=str, required=True, help='train_main(_plus).py checkpoint')
+    parser.add_argument('--model', type=str, default='auto', help='auto, vit, plus')
+    parser.add_argument('--modality', type=str, nargs='+', default=['sketch', 'photo'], help='sketch, photo')
+    parser.add_argument('--formats', type=str, nargs='+', default=['onnx', 'torchscript'], help='onnx, torchscript')
+    parser.add_argument('--output', type=str, default='./exported', help='output dir')
+    parser.add_argument('--num_classes', type=int, default=512, help='num classes')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ouput feature dim')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 7], help='token recycling scales')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--opset', type=int, default=18, help='ONNX opset')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='parity / latency batch sizes')
+    parser.add_argument('--atol', type=float, default=1e-4, help='max abs diff to eager')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    # exported on CPU in fp32, the runtimes pick their own device
+    example_images = torch.rand(2, 3, args.image_size, args.image_size)
+    for modality in args.modality:
+        encoder = load_encoder(args.checkpoint, modality=modality, model=args.model, num_classes=args.num_classes,
+                               feature_dim=args.feature_dim, scales=args.scales, device='cpu')
+        model = EmbeddingModel(encoder).eval()
+
+        runtimes = {'eager': model}
+        if 'torchscript' in args.formats:
+            runtimes['torchscript'] = export_torchscript(model, example_images,
+                                                         os.path.join(args.output, '{}_encoder.pt'.format(modality)))
+        if 'onnx' in args.formats:
+            session = export_onnx(model, example_images, os.path.join(args.output, '{}_encoder.onnx'.format(modality)),
+                                  opset=args.opset)
+            if session is not None:
+                runtimes['onnx'] = session
+
+        for name, runtime in runtimes.items():
+            for batch_size, diff, latency in check_parity(model, runtime, batch_sizes=args.batch_sizes,
+                                                          im_size=args.image_size, atol=args.atol):
+                print('[{}] {} batch {}: max abs diff {:.2e}, {:.2f} ms ({:.1f} img/s)'.format(
+                    modality, name, batch_size, diff, latency, batch_size / latency * 1000))
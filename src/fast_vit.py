@@ -0,0 +1,122 @@
+"""
+Acknowledgements:
+1. https://pytorch.org/docs/stable/generated/torch.nn.functional.scaled_dot_product_attention.html
+2. Dao et al., FlashAttention: Fast and Memory-Efficient Exact Attention with IO-Awareness, NeurIPS 2022
+3. https://pytorch.org/docs/stable/torch.compiler.html
+"""
+
+import time
+import argparse
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+class SDPAAttention(nn.Module):
+    # Drop-in for timm's ViT Attention that always runs scaled_dot_product_attention (flash / memory-efficient
+    # kernels on GPU, fused on CPU) instead of materializing the (B, H, N, N) softmax; it reuses the wrapped
+    # module's layers under the same names, so state dicts and checkpoints are unchanged
+    def __init__(self, attn):
+        super().__init__()
+        assert getattr(attn, 'gate', None) is None, 'gated attention is not supported'
+        self.num_heads = attn.num_heads
+        self.qkv = attn.qkv
+        self.q_norm = getattr(attn, 'q_norm', nn.Identity())
+        self.k_norm = getattr(attn, 'k_norm', nn.Identity())
+        self.attn_drop = attn.attn_drop
+        self.norm = getattr(attn, 'norm', nn.Identity())
+        self.proj = attn.proj
+        self.proj_drop = attn.proj_drop
+        # mask set from outside for blocks (older timm) whose forward does not pass one, see sparse_patch.py
+        self.attn_mask = None
+
+    def forward(self, x, attn_mask=None, is_causal=False):
+        B, N, _ = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)  # (B, H, N, D)
+        q, k = self.q_norm(q), self.k_norm(k)
+        attn_mask = self.attn_mask if attn_mask is None else attn_mask
+        if attn_mask is not None and attn_mask.is_floating_point():
+            attn_mask = attn_mask.to(q.dtype)  # additive bias, in the autocast dtype
+
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, is_causal=is_causal,
+                                           dropout_p=self.attn_drop.p if self.training else 0.)
+        x = self.norm(x.transpose(1, 2).reshape(B, N, -1))
+        return self.proj_drop(self.proj(x))
+
+
+def use_sdpa(model):
+    # model: EncoderViT (ViT_backbone or train_plus_utils), swaps the attention of every ViT block
+    for block in model.encoder.blocks:
+        if not isinstance(block.attn, SDPAAttention):
+            block.attn = SDPAAttention(block.attn)
+    return model
+
+
+def use_manual_attention(model):
+    # the explicit softmax(q k^T) v path of older timm releases, the benchmark baseline
+    for block in model.encoder.blocks:
+        if hasattr(block.attn, 'fused_attn'):
+            block.attn.fused_attn = False
+    return model
+
+
+def compile_embedding(model, mode=None):
+    # Compiles the ViT trunk as one graph (fullgraph raises on a graph break instead of silently splitting it);
+    # shapes are static, so each new batch size compiles once, keep drop_last batches for training.
+    # Activation checkpointing graph-breaks around every block, call after set_grad_checkpointing
+    fullgraph = not getattr(model, 'grad_checkpointing', False)
+    model.embedding = torch.compile(model.embedding, mode=mode, fullgraph=fullgraph, dynamic=False)
+    return model
+
+
+def accelerate_encoder(model, sdpa=True, compile=False, compile_mode=None):
+    if sdpa:
+        use_sdpa(model)
+    if compile:
+        compile_embedding(model, mode=compile_mode)
+    return model
+
+
+def benchmark_embedding(model, images, iters=10, warmup=3):
+    # images / s of model.embedding, the first warmup calls also absorb compilation
+    with torch.no_grad():
+        for _ in range(warmup):
+            model.embedding(images)
+        if images.is_cuda:
+            torch.cuda.synchronize(images.device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model.embedding(images)
+        if images.is_cuda:
+            torch.cuda.synchronize(images.device)
+    return len(images) * iters / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    from ViT_backbone import EncoderViT
+
+    parser = argparse.ArgumentParser(description='Eager vs SDPA vs compiled EncoderViT trunk throughput')
+    parser.add_argument('--encoder_backbone', type=str, default='vit_base_patch16_224', help='timm ViT')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ViT width')
+    parser.add_argument('--batch_size', type=int, default=8, help='benchmark batch size')
+    parser.add_argument('--iters', type=int, default=10, help='timed iterations')
+    parser.add_argument('--compile_mode', type=str, default=None, help='torch.compile mode, e.g. max-autotune')
+    parser.add_argument('--device', type=str, default='cpu', help='device')
+    args = parser.parse_args()
+
+    model = EncoderViT(num_classes=512, feature_dim=args.feature_dim, encoder_backbone=args.encoder_backbone)
+    model = use_manual_attention(model).to(args.device).eval()
+    images = torch.rand(args.batch_size, 3, 224, 224, device=args.device)
+    with torch.no_grad():
+        reference = model.embedding(images)
+
+    for name in ['eager', 'sdpa', 'sdpa + compile']:
+        if name == 'sdpa':
+            use_sdpa(model)
+        elif name == 'sdpa + compile':
+            compile_embedding(model, mode=args.compile_mode)
+        throughput = benchmark_embedding(model, images, iters=args.iters)
+        with torch.no_grad():
+            diff = (model.embedding(images) - reference).abs().max().item()
+        print('{:>14}: {:.1f} img/s, max abs diff to eager {:.2e}'.format(name, throughput, diff))
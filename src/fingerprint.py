@@ -0,0 +1,12 @@
+import os
+import hashlib
+
+
+def folder_fingerprint(folder_path, name_list, tag=''):
+    # names, sizes and mtimes of the listed files, so replacing a file in place also changes the key
+    sha = hashlib.sha1(tag.encode())
+    for name in name_list:
+        stat = os.stat(os.path.join(folder_path, name))
+        sha.update('{}:{}:{}\n'.format(name, stat.st_size, stat.st_mtime_ns).encode())
+
+    return sha.hexdigest()[:16]
@@ -0,0 +1,81 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from retrieval import encode_features
+from fingerprint import folder_fingerprint
+
+
+def model_fingerprint(model):
+    sha = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def build_gallery_index(img_model, data_set_img, index_path, batch_size=128, device='cuda'):
+    # per-process temp dir, every rank of a torchrun job may build the same index at once
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    data_loader_img = DataLoader(data_set_img, batch_size=batch_size,
+                                 shuffle=False, num_workers=2, pin_memory=True)
+
+    with torch.no_grad():
+        feat_dim = img_model(data_set_img[0].unsqueeze(0).to(device))[0].shape[1]
+        features = np.lib.format.open_memmap(os.path.join(tmp_path, 'features.npy'), mode='w+',
+                                             dtype=np.float32, shape=(len(data_set_img), feat_dim))
+        encode_features(img_model, data_loader_img, device=device, out=features)
+        features.flush()
+        del features
+
+    with open(os.path.join(tmp_path, 'names.json'), 'w') as f:
+        json.dump(list(data_set_img.img_list), f)
+
+    try:
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # another process renamed its identical copy first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(index_path, 'names.json')):
+            raise
+
+
+def load_gallery_index(img_model, data_set_img, index_dir='./gallery_index', batch_size=128, device='cuda'):
+    # Gallery features are keyed by the image model weights and the photo folder contents,
+    # so re-evaluating the same checkpoint only pays for the sketch side.
+    key = '{}_{}'.format(model_fingerprint(img_model),
+                         folder_fingerprint(data_set_img.img_folder_path, data_set_img.img_list,
+                                            tag=repr(data_set_img.transform)))
+    index_path = os.path.join(index_dir, key)
+
+    if not os.path.exists(os.path.join(index_path, 'names.json')):
+        print('Building gallery index [{}] ...'.format(index_path))
+        os.makedirs(index_dir, exist_ok=True)
+        build_gallery_index(img_model, data_set_img, index_path, batch_size=batch_size, device=device)
+    else:
+        print('Loading gallery index [{}] ...'.format(index_path))
+
+    features = np.load(os.path.join(index_path, 'features.npy'), mmap_mode='c')
+    with open(os.path.join(index_path, 'names.json')) as f:
+        names = json.load(f)
+
+    return features, names
+
+
+def get_gallery_features(img_model, data_set_img, batch_size=128, device='cuda', index_dir=None):
+    if index_dir is None:
+        data_loader_img = DataLoader(data_set_img, batch_size=batch_size,
+                                     shuffle=False, num_workers=2, pin_memory=True)
+        return encode_features(img_model, data_loader_img, device=device), list(data_set_img.img_list)
+
+    features, names = load_gallery_index(img_model, data_set_img, index_dir=index_dir,
+                                         batch_size=batch_size, device=device)
+    return torch.from_numpy(features).to(device), names
@@ -0,0 +1,67 @@
+"""
+Acknowledgements:
+1. https://github.com/luyug/GradCache
+2. Gao et al., Scaling Deep Contrastive Learning Batch Size under Memory Limited Setup, RepL4NLP 2021
+"""
+
+from contextlib import nullcontext
+import torch
+
+
+class RandContext:
+    # RNG state captured before the no-grad pass, so the replay draws the same dropout / drop path masks
+    def __init__(self, *tensors):
+        self.devices = sorted({tensor.device.index for tensor in tensors if tensor.is_cuda})
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_states = [torch.cuda.get_rng_state(device) for device in self.devices]
+        self.fork = None
+
+    def __enter__(self):
+        self.fork = torch.random.fork_rng(devices=self.devices)
+        self.fork.__enter__()
+        torch.set_rng_state(self.cpu_state)
+        for device, state in zip(self.devices, self.cuda_states):
+            torch.cuda.set_rng_state(state, device)
+
+    def __exit__(self, *exc):
+        self.fork.__exit__(*exc)
+        self.fork = None
+
+
+def grad_cache_step(encode, inputs, loss_fn, micro_batch_size, scaler=None, no_sync=None):
+    # encode(*micro_inputs) -> tuple of representations, (b, ...) tensors or per micro-batch scalars
+    # loss_fn(*full_batch_representations) -> (loss, ...), returned as is
+    # no_sync: e.g. DistributedDataParallel.no_sync, gradients are then all-reduced once, in the last replay
+    micro_inputs = list(zip(*[tensor.split(micro_batch_size) for tensor in inputs]))
+    micro_sizes = [len(micro[0]) for micro in micro_inputs]
+
+    # 1. representations of every micro-batch, no activations kept
+    rand_states, micro_reps = [], []
+    with torch.no_grad():
+        for micro in micro_inputs:
+            rand_states.append(RandContext(*micro))
+            micro_reps.append(encode(*micro))
+
+    # 2. full-batch loss on the cached representations, gradients stop at them
+    scalar = [rep.dim() == 0 for rep in micro_reps[0]]
+    reps = [(torch.stack(rep) if is_scalar else torch.cat(rep)).detach().requires_grad_()
+            for rep, is_scalar in zip(zip(*micro_reps), scalar)]
+    outputs = loss_fn(*reps)
+    loss = outputs[0] if scaler is None else scaler.scale(outputs[0])
+    loss.backward()
+
+    rep_grads = [[None] * len(micro_inputs) if rep.grad is None else
+                 rep.grad.unbind(0) if is_scalar else rep.grad.split(micro_sizes)
+                 for rep, is_scalar in zip(reps, scalar)]
+
+    # 3. replay each micro-batch with the graph and push the cached gradients into the encoders
+    for idx, (micro, rand_state) in enumerate(zip(micro_inputs, rand_states)):
+        last = idx == len(micro_inputs) - 1
+        with nullcontext() if no_sync is None or last else no_sync():
+            with rand_state:
+                micro_rep = encode(*micro)
+            surrogate = sum((rep * grads[idx]).sum() for rep, grads in zip(micro_rep, rep_grads)
+                            if grads[idx] is not None)
+            surrogate.backward()
+
+    return outputs
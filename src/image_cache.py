@@ -0,0 +1,105 @@
+import os
+import json
+import shutil
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+from torchvision.transforms import Compose, Resize, ConvertImageDtype
+from concurrent.futures import ThreadPoolExecutor
+
+from fingerprint import folder_fingerprint
+
+
+class ImageCache:
+    # Decoded RGB images at their original size, packed back to back into one flat uint8 .npy
+    # (shapes.npy holds each (H, W, 3)), read back through a memory map
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        with open(os.path.join(cache_path, 'names.json')) as f:
+            self.names = json.load(f)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.shapes = np.load(os.path.join(cache_path, 'shapes.npy'))
+        self.offsets = np.concatenate(([0], np.cumsum(self.shapes.prod(axis=1))))
+        self.images = None
+
+    def __getitem__(self, name):
+        # opened lazily so every dataloader worker maps the file itself instead of unpickling a copy;
+        # copy-on-write, so the views are writable for torch.from_numpy without copying the pixels
+        if self.images is None:
+            self.images = np.load(os.path.join(self.cache_path, 'images.npy'), mmap_mode='c')
+        row = self.rows[name]
+        return self.images[self.offsets[row]:self.offsets[row + 1]].reshape(self.shapes[row])  # zero-copy view
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+
+def decode_image(path):
+    return np.array(Image.open(path).convert('RGB'))  # (H, W, 3) uint8, path or file object
+
+
+def read_image(path):
+    return torch.from_numpy(decode_image(path)).permute(2, 0, 1)  # (3, H, W) uint8
+
+
+def build_image_cache(folder_path, name_list, cache_path, num_workers=8):
+    # per-process temp dir, every rank of a torchrun job may build the same cache at once
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # image sizes come from the headers, so the flat array is allocated before anything is decoded
+    paths = [os.path.join(folder_path, name) for name in name_list]
+    shapes = np.array([Image.open(path).size[::-1] + (3,) for path in paths], dtype=np.int64).reshape(-1, 3)
+    offsets = np.concatenate(([0], np.cumsum(shapes.prod(axis=1))))
+    images = np.lib.format.open_memmap(os.path.join(tmp_path, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(int(offsets[-1]),))
+    with ThreadPoolExecutor(num_workers) as executor:
+        for row, image in enumerate(tqdm(executor.map(decode_image, paths), total=len(paths))):
+            images[offsets[row]:offsets[row + 1]] = image.reshape(-1)
+    images.flush()
+    del images
+
+    np.save(os.path.join(tmp_path, 'shapes.npy'), shapes)
+    with open(os.path.join(tmp_path, 'names.json'), 'w') as f:
+        json.dump(list(name_list), f)
+
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # another process renamed its identical copy first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(cache_path, 'names.json')):
+            raise
+
+
+def load_image_cache(folder_path, name_list, cache_dir='./image_cache'):
+    key = folder_fingerprint(folder_path, name_list, tag='rgb')
+    cache_path = os.path.join(cache_dir, key)
+
+    if not os.path.exists(os.path.join(cache_path, 'names.json')):
+        print('Building image cache [{}] for {} ...'.format(cache_path, folder_path))
+        os.makedirs(cache_dir, exist_ok=True)
+        build_image_cache(folder_path, name_list, cache_path)
+
+    return ImageCache(cache_path)
+
+
+def open_image(folder_path, name, image_cache=None):
+    # (3, H, W) uint8 tensor of the original image, the same pixels with or without the cache,
+    # for tensor transforms (Resize(..., antialias=True), ConvertImageDtype)
+    if image_cache is None:
+        return read_image(os.path.join(folder_path, name))
+    return torch.from_numpy(image_cache[name]).permute(2, 0, 1)
+
+
+def eval_transform(im_size=224):
+    # uint8 (3, H, W) -> float (3, im_size, im_size) in [0, 1]; the one test-time preprocessing,
+    # shared by get_acc, the gallery index, embed.py and serve.py
+    return Compose([Resize((im_size, im_size), antialias=True), ConvertImageDtype(torch.float)])
@@ -0,0 +1,64 @@
+"""
+Acknowledgements:
+1. https://github.com/facebookresearch/moco/blob/main/moco/builder.py
+2. He et al., Momentum Contrast for Unsupervised Visual Representation Learning, CVPR 2020
+"""
+
+import copy
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+class FeatureQueue(nn.Module):
+    # Ring buffer of L2-normalized key features from past batches, used as extra negatives
+    def __init__(self, feature_dim=512, queue_size=65536):
+        super().__init__()
+        self.register_buffer('queue', F.normalize(torch.randn(queue_size, feature_dim), dim=1))
+        self.register_buffer('ptr', torch.zeros((), dtype=torch.long))
+
+    @torch.no_grad()
+    def enqueue(self, keys):
+        keys = F.normalize(keys.detach().float(), dim=1)
+        queue_size = len(self.queue)
+        if len(keys) >= queue_size:
+            keys = keys[-queue_size:]
+
+        # write with wrap-around, the pointer stays on device so no host sync per step
+        rows = (self.ptr + torch.arange(len(keys), device=keys.device)) % queue_size
+        self.queue.index_copy_(0, rows, keys)
+        self.ptr.copy_((self.ptr + len(keys)) % queue_size)
+
+
+class MomentumEncoder(nn.Module):
+    # Frozen EMA copy of an encoder that produces the keys, so queued features drift slowly across steps
+    def __init__(self, model, momentum=0.999):
+        super().__init__()
+        self.momentum = momentum
+        self.model = copy.deepcopy(model)
+        for param in self.model.parameters():
+            param.requires_grad = False
+
+    @torch.no_grad()
+    def update(self, model):
+        key_params = list(self.model.parameters())
+        params = [param.detach() for param in model.parameters()]
+        torch._foreach_mul_(key_params, self.momentum)
+        torch._foreach_add_(key_params, params, alpha=1. - self.momentum)
+
+    @torch.no_grad()
+    def forward(self, image):
+        return self.model(image)[0]  # mlp features, like EncoderViT.forward()[0]
+
+
+def queue_cross_loss(query, key, queue, args):
+    # InfoNCE of each query against its own key, with the other in-batch keys and the whole queue as negatives
+    query = F.normalize(query, dim=1)
+    key = F.normalize(key, dim=1)
+
+    logits_batch = torch.matmul(query, key.T)  # (B, B), positives on the diagonal
+    logits_queue = torch.matmul(query, queue.queue.T.to(query.dtype))  # (B, K), one matmul for all negatives
+    logits = torch.cat((logits_batch, logits_queue), dim=1).float() / args.temperature  # fp32 under autocast
+
+    labels = torch.arange(len(query), device=query.device)
+    return F.cross_entropy(logits, labels)
@@ -0,0 +1,60 @@
+import time
+from functools import wraps
+import torch
+
+PRECISIONS = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def device_type(device):
+    return torch.device(device).type
+
+
+def resolve_precision(precision, device):
+    # fp16 autocast is a CUDA path, CPU training runs fp32 unless bf16 is asked for
+    assert precision in PRECISIONS, 'precision must be one of {}'.format(list(PRECISIONS))
+    if precision == 'fp16' and device_type(device) != 'cuda':
+        print('fp16 needs CUDA, training in fp32 on {} (use --precision bf16 for CPU mixed precision)'.format(device))
+        return 'fp32'
+    if precision == 'bf16' and device_type(device) == 'cuda' and not torch.cuda.is_bf16_supported():
+        print('bf16 is not supported on this GPU, training in fp16')
+        return 'fp16'
+    return precision
+
+
+def autocast(precision, device):
+    return torch.autocast(device_type(device), dtype=PRECISIONS[precision], enabled=precision != 'fp32')
+
+
+def with_autocast(fn, precision, device):
+    # runs fn under autocast, e.g. the encode / loss closures of a training step, backward stays outside
+    @wraps(fn)
+    def autocast_fn(*args, **kwargs):
+        with autocast(precision, device):
+            return fn(*args, **kwargs)
+    return autocast_fn
+
+
+def make_scaler(precision, device):
+    # only fp16 gradients underflow, bf16 has the fp32 exponent range
+    return torch.amp.GradScaler(device_type(device), enabled=precision == 'fp16')
+
+
+class StepTimer:
+    # training steps / samples per second since the last reset (CUDA work is synchronized before reading)
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.steps, self.samples = 0, 0
+        self.start = time.perf_counter()
+
+    def step(self, num_samples):
+        self.steps += 1
+        self.samples += num_samples
+
+    def rates(self):
+        if device_type(self.device) == 'cuda':
+            torch.cuda.synchronize(self.device)
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return self.steps / elapsed, self.samples / elapsed
@@ -0,0 +1,148 @@
+"""
+Acknowledgements:
+1. https://pytorch.org/docs/stable/quantization.html
+2. https://pytorch.org/tutorials/intermediate/memory_format_tutorial.html
+"""
+
+import copy
+import time
+import argparse
+import torch
+from torch import nn
+
+from embed import load_encoder
+
+
+def quantize_dynamic(model):
+    # int8 weights, activations quantized on the fly: covers the ViT qkv / proj / mlp Linears and the heads,
+    # MultiheadAttention keeps its (non-quantizable) out_proj in fp32
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_batches, backend='x86'):
+    # int8 weights and activations for the CNN backbones (FX graph mode), activation ranges are observed
+    # on the calibration batches; ViTs stay on quantize_dynamic, their LayerNorm / softmax do not quantize well
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    calibration_batches = list(calibration_batches)
+    prepared = prepare_fx(model.eval(), get_default_qconfig_mapping(backend), (calibration_batches[0],))
+    with torch.no_grad():
+        for images in calibration_batches:
+            prepared(images)
+    return convert_fx(prepared)
+
+
+class CPUEncoder(nn.Module):
+    # Feeds channels-last images to a channels-last model, the conv patch embedding / CNN layers
+    # run faster in that layout on CPU. Converts a copy, the caller's model stays the fp32 reference
+    def __init__(self, model, channels_last=False):
+        super().__init__()
+        self.model = copy.deepcopy(model).to(memory_format=torch.channels_last) if channels_last else model
+        self.channels_last = channels_last
+
+    def forward(self, image):
+        if self.channels_last:
+            image = image.contiguous(memory_format=torch.channels_last)
+        return self.model(image)
+
+
+def prepare_for_cpu(model, quantize='dynamic', channels_last=False, compile=None, example_images=None,
+                    calibration_batches=None, num_threads=None):
+    # quantize: none, dynamic, static (CNN backbones, needs calibration_batches)
+    # compile: None, 'trace' (TorchScript, needs example_images) or 'compile' (torch.compile)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = model.cpu().eval()
+
+    if quantize == 'dynamic':
+        model = quantize_dynamic(model)
+    elif quantize == 'static':
+        model = quantize_static(model, calibration_batches)
+    model = CPUEncoder(model, channels_last=channels_last).eval()
+
+    if compile == 'trace':
+        with torch.no_grad():
+            model = torch.jit.freeze(torch.jit.trace(model, example_images))
+    elif compile == 'compile':
+        model = torch.compile(model)
+    return model
+
+
+def benchmark(model, batch_size=1, im_size=224, iters=20, warmup=3):
+    # mean latency (ms) of one forward over a random batch
+    images = torch.rand(batch_size, 3, im_size, im_size)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(images)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(images)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def build_cnn(name):
+    from CNN_backbone import Backbone_Inception, Backbone_Resnet50, Backbone_VGG16
+    return {'inception': Backbone_Inception, 'resnet50': Backbone_Resnet50, 'vgg16': Backbone_VGG16}[name]()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU inference: int8 quantization, latency and accuracy parity')
+    parser.add_argument('--checkpoint', type=str, default=None, help='train_main(_plus).py checkpoint')
+    parser.add_argument('--model', type=str, default='auto', help='auto, vit, plus, resnet50, vgg16, inception')
+    parser.add_argument('--num_classes', type=int, default=512, help='num classes')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ouput feature dim')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 7], help='token recycling scales')
+    parser.add_argument('--quantize', type=str, default='dynamic', help='none, dynamic, static (CNN)')
+    parser.add_argument('--channels_last', action='store_true', help='channels-last memory format')
+    parser.add_argument('--compile', type=str, default=None, help='trace (TorchScript), compile (torch.compile)')
+    parser.add_argument('--num_threads', type=int, default=None, help='intra-op CPU threads')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32], help='benchmark batch sizes')
+    parser.add_argument('--dataset', type=str, default=None, help='run the fp32 / int8 get_acc parity check')
+    parser.add_argument('--max_top1_drop', type=float, default=1.0, help='max allowed top1 drop of the check')
+    parser.add_argument('--save', type=str, default=None, help='save the prepared sketch and photo encoders')
+    args = parser.parse_args()
+
+    example_images = torch.rand(1, 3, args.image_size, args.image_size)
+    if args.model in ['resnet50', 'vgg16', 'inception']:
+        # the CNN baselines have no checkpoint format here, latency only
+        models = {'cnn': build_cnn(args.model).eval()}
+    else:
+        models = {modality: load_encoder(args.checkpoint, modality=modality, model=args.model,
+                                         num_classes=args.num_classes, feature_dim=args.feature_dim,
+                                         scales=args.scales, device='cpu')
+                  for modality in ['sketch', 'photo']}
+
+    prepared = {}
+    for name, model in models.items():
+        calibration_batches = [torch.rand(8, 3, args.image_size, args.image_size) for _ in range(4)]
+        prepared[name] = prepare_for_cpu(model, quantize=args.quantize, channels_last=args.channels_last,
+                                         compile=args.compile, example_images=example_images,
+                                         calibration_batches=calibration_batches, num_threads=args.num_threads)
+
+    name = next(iter(models))
+    for batch_size in args.batch_sizes:
+        fp32_ms = benchmark(models[name], batch_size=batch_size, im_size=args.image_size)
+        int8_ms = benchmark(prepared[name], batch_size=batch_size, im_size=args.image_size)
+        print('Batch {}: fp32 {:.2f} ms, {} {:.2f} ms ({:.2f}x)'.format(batch_size, fp32_ms, args.quantize, int8_ms,
+                                                                      fp32_ms / int8_ms))
+
+    if args.dataset is not None and 'sketch' in models:
+        if args.model == 'plus' or type(models['sketch']).__module__ == 'train_plus_utils':
+            from train_plus_utils import get_acc
+        else:
+            from train_utils import get_acc
+        fp32_acc = get_acc(models['sketch'], models['photo'], dataset=args.dataset, mode='test', device='cpu')
+        int8_acc = get_acc(prepared['sketch'], prepared['photo'], dataset=args.dataset, mode='test', device='cpu')
+        print('fp32 top1/5/10: {}, {} top1/5/10: {}'.format(fp32_acc, args.quantize, int8_acc))
+        if fp32_acc[0] - int8_acc[0] > args.max_top1_drop:
+            raise SystemExit('top1 dropped by {:.3f} > {}'.format(fp32_acc[0] - int8_acc[0], args.max_top1_drop))
+
+    if args.save is not None:
+        if args.compile == 'trace':
+            for name, model in prepared.items():
+                torch.jit.save(model, '{}_{}.pt'.format(args.save, name))
+        else:
+            torch.save(prepared, args.save)
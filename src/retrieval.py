@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+def encode_features(model, data_loader, device='cuda', out=None):
+    # Writes normalized features into a bank sized from len(data_loader.dataset), or into `out`
+    # (e.g. a np.memmap), instead of growing it with torch.cat on every batch.
+    # Batches may be (images, ...) tuples, only the images are encoded.
+    feature_bank = out
+    start = 0
+    for batch in tqdm(data_loader, disable=dist.is_initialized() and dist.get_rank() != 0):
+        imgs = batch[0] if isinstance(batch, (list, tuple)) else batch
+        feats, _ = model(imgs.to(device))
+        feats = F.normalize(feats, dim=1).detach()
+
+        if feature_bank is None:
+            feature_bank = torch.empty((len(data_loader.dataset), feats.shape[1]), dtype=feats.dtype, device=device)
+        if isinstance(feature_bank, np.ndarray):
+            feature_bank[start:start + len(feats)] = feats.float().cpu().numpy()
+        else:
+            feature_bank[start:start + len(feats)] = feats
+        start += len(feats)
+
+    return feature_bank
+
+
+def gallery_chunks(gallery_feats, device, chunk_size=65536):
+    # gallery_feats: (N, D) torch tensor or numpy array (e.g. a memory-mapped gallery index)
+    for start in range(0, len(gallery_feats), chunk_size):
+        chunk = gallery_feats[start:start + chunk_size]
+        if isinstance(chunk, np.ndarray):
+            chunk = torch.from_numpy(np.ascontiguousarray(chunk))
+        yield start, chunk.to(device=device, dtype=torch.float32, non_blocking=True)
+
+
+def chunked_topk(query_feats, gallery_feats, k=10, chunk_size=65536):
+    # Running top-k over gallery chunks, never materializing the (B, N) similarity or sort index
+    top_scores, top_idx = None, None
+    for start, chunk in gallery_chunks(gallery_feats, query_feats.device, chunk_size):
+        similarity = torch.matmul(query_feats, chunk.T)  # (B, chunk)
+        scores, idx = similarity.topk(min(k, chunk.shape[0]), dim=1)
+        idx = idx + start
+
+        if top_scores is not None:
+            scores = torch.cat((top_scores, scores), dim=1)
+            idx = torch.cat((top_idx, idx), dim=1)
+            scores, order = scores.topk(min(k, scores.shape[1]), dim=1)
+            idx = torch.gather(idx, 1, order)
+        top_scores, top_idx = scores, idx
+
+    return top_scores, top_idx
+
+
+def target_rank(query_feats, gallery_feats, target_idx, chunk_size=65536, query_chunk=4096):
+    # 0-based rank of the ground-truth item: number of gallery items scoring strictly higher
+    target_idx = target_idx.to(query_feats.device)
+    if isinstance(gallery_feats, np.ndarray):
+        target_feats = torch.from_numpy(gallery_feats[target_idx.cpu().numpy()])
+    else:
+        target_feats = gallery_feats[target_idx.to(gallery_feats.device)]
+    target_feats = target_feats.to(device=query_feats.device, dtype=torch.float32)
+    target_score = (query_feats * target_feats).sum(dim=1, keepdim=True)  # (B, 1)
+
+    rank = torch.zeros(len(query_feats), dtype=torch.long, device=query_feats.device)
+    for q_start in range(0, len(query_feats), query_chunk):
+        q_end = q_start + query_chunk
+        for start, chunk in gallery_chunks(gallery_feats, query_feats.device, chunk_size):
+            similarity = torch.matmul(query_feats[q_start:q_end], chunk.T)  # (b, chunk)
+            columns = torch.arange(start, start + chunk.shape[0], device=query_feats.device)
+            higher = (similarity > target_score[q_start:q_end]) & \
+                     (columns.unsqueeze(0) != target_idx[q_start:q_end].unsqueeze(1))
+            rank[q_start:q_end] += higher.sum(dim=1)
+
+    return rank
+
+
+def topk_accuracy(rank, topk=(1, 5, 10)):
+    return tuple(round((rank < k).sum().item() / len(rank) * 100, 3) for k in topk)
@@ -0,0 +1,240 @@
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from ann_index import build_index, load_index
+from image_cache import read_image, eval_transform
+from embed import load_encoder, load_embeddings
+from sparse_patch import SparsePatchEncoder
+
+
+def load_gallery(gallery_dir):
+    # embed.py output (manifest.json + shards) or a gallery_index entry (features.npy + names.json)
+    if os.path.exists(os.path.join(gallery_dir, 'manifest.json')):
+        return load_embeddings(gallery_dir)
+
+    features = np.load(os.path.join(gallery_dir, 'features.npy'), mmap_mode='r')
+    with open(os.path.join(gallery_dir, 'names.json')) as f:
+        names = json.load(f)
+    return features, names
+
+
+class ServingStats:
+    # Latencies of the last `window` requests, for p50 / p99, and running counters for throughput
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+
+    def add_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.num_requests += len(latencies)
+            self.num_batches += 1
+
+    def add_error(self):
+        with self.lock:
+            self.num_errors += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            uptime = time.time() - self.start_time
+            return {'requests': self.num_requests, 'batches': self.num_batches, 'errors': self.num_errors,
+                    'uptime_s': round(uptime, 3),
+                    'throughput_qps': round(self.num_requests / max(uptime, 1e-9), 3),
+                    'mean_batch_size': round(float(np.mean(self.batch_sizes)), 3) if self.batch_sizes else 0,
+                    'p50_ms': round(float(np.percentile(latencies, 50)), 3) if len(latencies) else None,
+                    'p99_ms': round(float(np.percentile(latencies, 99)), 3) if len(latencies) else None}
+
+
+class QueryRequest:
+    def __init__(self, image, k):
+        self.image = image
+        self.k = k
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DynamicBatcher:
+    # A single worker thread owns the model: requests queue up while a batch runs and the next batch takes up
+    # to max_batch of them, waiting at most max_wait_ms after the first one for the batch to fill
+    def __init__(self, skt_model, index, ids, max_batch=32, max_wait_ms=5, max_k=100, device='cuda', stats=None):
+        self.skt_model = skt_model
+        self.index = index
+        self.ids = ids
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_k = max_k
+        self.device = device
+        self.stats = stats or ServingStats()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def max_results(self):
+        return min(self.max_k, len(self.ids))
+
+    def query(self, image, k=10, timeout=None):
+        # image: (3, H, W) tensor, blocks until its batch is done -> [(id, score), ...]
+        if not 1 <= k <= self.max_results():
+            raise ValueError('k must be in [1, {}], got {}'.format(self.max_results(), k))
+        request = QueryRequest(image, k)
+        self.requests.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError('query not served within {} s'.format(timeout))
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def encode(self, images):
+        if hasattr(self.skt_model, 'recycle_model'):
+            # the plus recycling transformer is not batch_first and attends across the batch, its head runs
+            # per sketch so a result does not depend on the requests it was batched with
+            vit_feats = self.skt_model.embedding(images)
+            return torch.cat([self.skt_model.head(vit_feat[None]) for vit_feat in vit_feats])
+        skt_feats, _ = self.skt_model(images)
+        return skt_feats
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                with torch.no_grad():
+                    images = torch.stack([request.image for request in batch]).to(self.device, non_blocking=True)
+                    skt_feats = F.normalize(self.encode(images).float(), dim=1)
+                    scores, idx = self.index.search(skt_feats, k=max(request.k for request in batch))
+                    scores, idx = scores.cpu().tolist(), idx.cpu().tolist()
+                for request, request_scores, request_idx in zip(batch, scores, idx):
+                    request.result = [(self.ids[i], round(s, 6))
+                                      for i, s in zip(request_idx[:request.k], request_scores[:request.k])]
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            finished = time.time()
+            self.stats.add_batch([finished - request.arrival for request in batch])
+            for request in batch:
+                request.done.set()
+
+
+def make_handler(batcher, transform, timeout=30):
+    class QueryHandler(BaseHTTPRequestHandler):
+        # POST /query?k=10 with the raw sketch image as body, GET /stats
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/stats':
+                self.send_json(200, batcher.stats.summary())
+            else:
+                self.send_json(404, {'error': 'unknown path'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/query':
+                self.send_json(404, {'error': 'unknown path'})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                k = int(parse_qs(url.query).get('k', [10])[0])
+                if not 1 <= k <= batcher.max_results():
+                    raise ValueError('k must be in [1, {}], got {}'.format(batcher.max_results(), k))
+                # decoding runs here, in the request thread, so it overlaps with the batched forward
+                image = transform(read_image(io.BytesIO(body)))
+            except Exception as e:
+                batcher.stats.add_error()
+                self.send_json(400, {'error': 'bad request: {}'.format(e)})
+                return
+            try:
+                result = batcher.query(image, k=k, timeout=timeout)
+            except Exception as e:
+                batcher.stats.add_error()
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, {'ids': [item_id for item_id, _ in result],
+                                 'scores': [score for _, score in result]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve sketch queries against a precomputed photo gallery')
+    parser.add_argument('--checkpoint', type=str, required=True, help='train_main(_plus).py checkpoint')
+    parser.add_argument('--gallery', type=str, required=True, help='embed.py output dir or gallery_index entry')
+    parser.add_argument('--ann_index', type=str, default=None, help='ann_index.py .npz over the same gallery')
+    parser.add_argument('--model', type=str, default='auto', help='auto, vit, plus')
+    parser.add_argument('--num_classes', type=int, default=512, help='num classes')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ouput feature dim')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 7], help='token recycling scales')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--max_batch', type=int, default=32, help='max sketches per forward')
+    parser.add_argument('--max_wait_ms', type=float, default=5, help='max wait for a batch to fill')
+    parser.add_argument('--max_k', type=int, default=100, help='max results per query')
+    parser.add_argument('--sparse_threshold', type=float, default=None, help='drop sketch patches with pixel '
+                        'variance at most this before the ViT blocks (e.g. 4, off by default, plain ViT only)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='bind address')
+    parser.add_argument('--port', type=int, default=8000, help='port')
+    parser.add_argument('--device', type=str, default='cuda', help='device')
+    args = parser.parse_args()
+
+    skt_model = load_encoder(args.checkpoint, modality='sketch', model=args.model, num_classes=args.num_classes,
+                             feature_dim=args.feature_dim, scales=args.scales, device=args.device)
+    if args.sparse_threshold is not None:
+        skt_model = SparsePatchEncoder(skt_model, threshold=args.sparse_threshold).eval()
+    features, ids = load_gallery(args.gallery)
+    if args.ann_index is not None:
+        index = load_index(args.ann_index, device=args.device)
+    else:
+        index = build_index('exact', features, device=args.device)
+    print('Gallery of {} photos loaded from {}'.format(len(ids), args.gallery))
+
+    batcher = DynamicBatcher(skt_model, index, ids, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms,
+                             max_k=args.max_k, device=args.device)
+    transform = eval_transform(args.image_size)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, transform))
+    print('Serving on http://{}:{} (POST /query?k=10, GET /stats)'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.summary()))
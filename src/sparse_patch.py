@@ -0,0 +1,150 @@
+import time
+import argparse
+from contextlib import contextmanager
+import torch
+from torch import nn
+
+from fast_vit import use_sdpa
+
+
+def empty_patches(images, patch_size=16, threshold=4.0):
+    # (B, N) True where a patch is flat: pixel variance over the patch (all channels, 0-255 scale) <= threshold.
+    # Takes uint8 images or ToTensor floats in [0, 1]
+    images = images.float() if images.dtype == torch.uint8 else images.float() * 255
+    B, C, H, W = images.shape
+    patches = images.view(B, C, H // patch_size, patch_size, W // patch_size, patch_size)
+    patches = patches.permute(0, 2, 4, 1, 3, 5).reshape(B, (H // patch_size) * (W // patch_size), -1)
+    return patches.var(dim=-1, unbiased=False) <= threshold
+
+
+@contextmanager
+def attention_mask(blocks, mask):
+    # older timm blocks take no mask argument, so it is handed to the SDPA attention modules directly
+    for block in blocks:
+        block.attn.attn_mask = mask
+    try:
+        yield
+    finally:
+        for block in blocks:
+            block.attn.attn_mask = None
+
+
+class SparsePatchEncoder(nn.Module):
+    # Approximate sketch fast path of a plain EncoderViT: flat background patches are dropped before the ViT blocks.
+    # One of them stays as the stand-in for all, with log(count) added to its attention logits so it keeps the
+    # weight of the whole background. Background tokens still differ by their pos_embed, so the output is close
+    # to the dense one, never equal. The kept tokens of a batch are packed left into a padded (B, L, C) sequence,
+    # padding is masked out of attention, so a sketch gets the same output alone or in any batch.
+    # The plus model is not supported: its recycling transformer is not batch_first and attends across the batch,
+    # so its output would depend on the padded length of the other sketches.
+    def __init__(self, model, threshold=4.0):
+        super().__init__()
+        if hasattr(model, 'recycle_model') or not hasattr(model, 'encoder'):
+            raise ValueError('SparsePatchEncoder needs a plain EncoderViT (ViT_backbone.py) sketch encoder')
+        self.model = use_sdpa(model)
+        self.threshold = threshold
+        self.patch_size = model.encoder.patch_embed.patch_size
+        self.patch_size = self.patch_size[0] if isinstance(self.patch_size, (list, tuple)) else self.patch_size
+
+    def pack(self, image):
+        encoder = self.model.encoder
+        empty = empty_patches(image, self.patch_size, self.threshold)  # (B, N)
+        B, N = empty.shape
+        rows = torch.arange(B, device=image.device).unsqueeze(1)
+
+        # first empty patch of each sample stands in for all of them
+        has_empty = empty.any(dim=1, keepdim=True)
+        stand_in = empty.float().argmax(dim=1, keepdim=True)
+        keep = ~empty
+        keep[rows, stand_in] |= has_empty
+        size = torch.ones(B, N, device=image.device)
+        size[rows, stand_in] = torch.where(has_empty, empty.sum(dim=1, keepdim=True).float(), 1.)
+
+        # kept patches first, in patch order, then padding
+        lengths = keep.sum(dim=1)
+        num_kept = int(lengths.max())
+        index = torch.argsort((~keep).to(torch.uint8), dim=1, stable=True)[:, :num_kept]  # (B, L)
+        valid = torch.arange(num_kept, device=image.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+        # patch embedding is one conv over the image, cheap next to the blocks; tokens are gathered after it
+        num_prefix = 1 if encoder.dist_token is None else 2
+        x = encoder.patch_embed(image) + encoder.pos_embed[:, num_prefix:]
+        x = x.gather(1, index.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+        prefix = encoder.cls_token.expand(B, -1, -1)
+        if encoder.dist_token is not None:
+            prefix = torch.cat((prefix, encoder.dist_token.expand(B, -1, -1)), dim=1)
+        x = encoder.pos_drop(torch.cat((prefix + encoder.pos_embed[:, :num_prefix], x), dim=1))
+
+        bias = torch.where(valid, size.gather(1, index).log(), torch.tensor(float('-inf'), device=image.device))
+        bias = torch.cat((bias.new_zeros(B, num_prefix), bias), dim=1)[:, None, None, :]  # (B, 1, 1, P + L)
+        return x, bias
+
+    def embedding(self, image):
+        # (B, P + L, C) packed tokens, padding included
+        x, bias = self.pack(image)
+        blocks = self.model.encoder.blocks
+        with attention_mask(blocks, bias):
+            x = blocks(x)
+        return self.model.encoder.norm(x)
+
+    def forward(self, image):
+        vit_feat = self.embedding(image)
+        return self.model.mlp_head(vit_feat[:, 0]), vit_feat
+
+
+def latency(model, images, iters=10, warmup=2):
+    # ms per forward of the given batch
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(images)
+        if images.is_cuda:
+            torch.cuda.synchronize(images.device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(images)
+        if images.is_cuda:
+            torch.cuda.synchronize(images.device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+if __name__ == '__main__':
+    import copy
+    from torch.utils.data import DataLoader
+    from image_cache import eval_transform
+    from data_loader import LoadDatasetSkt
+    from train_utils import get_acc
+    from embed import load_encoder
+
+    parser = argparse.ArgumentParser(description='Sparse sketch patch embedding: accuracy and latency vs dense')
+    parser.add_argument('--checkpoint', type=str, required=True, help='train_main(_plus).py checkpoint')
+    parser.add_argument('--dataset', type=str, default='ClothesV1', help='ClothesV1, ChairV2, ShoeV2')
+    parser.add_argument('--model', type=str, default='auto', help='auto, vit (plus is not supported)')
+    parser.add_argument('--num_classes', type=int, default=512, help='num classes')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ouput feature dim')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 7], help='token recycling scales')
+    parser.add_argument('--threshold', type=float, default=4.0, help='max pixel variance of an empty patch')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32], help='latency batch sizes')
+    parser.add_argument('--device', type=str, default='cuda', help='device')
+    args = parser.parse_args()
+
+    skt_model = load_encoder(args.checkpoint, modality='sketch', model=args.model, num_classes=args.num_classes,
+                             feature_dim=args.feature_dim, scales=args.scales, device=args.device)
+    img_model = load_encoder(args.checkpoint, modality='photo', model=args.model, num_classes=args.num_classes,
+                             feature_dim=args.feature_dim, scales=args.scales, device=args.device)
+    sparse_model = SparsePatchEncoder(copy.deepcopy(skt_model), threshold=args.threshold).eval()
+
+    # latency and kept patches on real test sketches, the photo encoder is the same dense model in both runs
+    data_set_skt = LoadDatasetSkt(img_folder_path='./datasets/{}/testB/'.format(args.dataset),
+                                  skt_folder_path='./datasets/{}/testA/'.format(args.dataset),
+                                  transform=eval_transform())
+    sketches = next(iter(DataLoader(data_set_skt, batch_size=max(args.batch_sizes), shuffle=True)))[0]
+    kept = (~empty_patches(sketches, sparse_model.patch_size, args.threshold)).float().mean().item()
+    print('Non-empty sketch patches: {:.1f} %'.format(kept * 100))
+    for batch_size in args.batch_sizes:
+        images = sketches[:batch_size].to(args.device)
+        print('Batch {}: dense {:.2f} ms, sparse {:.2f} ms'.format(batch_size, latency(skt_model, images),
+                                                                  latency(sparse_model, images)))
+
+    dense_acc = get_acc(skt_model, img_model, dataset=args.dataset, mode='test', device=args.device)
+    sparse_acc = get_acc(sparse_model, img_model, dataset=args.dataset, mode='test', device=args.device)
+    print('dense top1/5/10: {}, sparse (approximate) top1/5/10: {}'.format(dense_acc, sparse_acc))
@@ -0,0 +1,168 @@
+"""
+Acknowledgements:
+1. https://github.com/facebookresearch/ToMe
+2. Bolya et al., Token Merging: Your ViT But Faster, ICLR 2023
+"""
+
+import time
+import argparse
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+def bipartite_soft_matching(metric, r):
+    # Splits the tokens into alternating sets A / B, merges the r tokens of A most similar to some token of B
+    # into it; the cls token (index 0) is never merged and stays first.
+    # Returns merge(x, size) -> (merged x, merged size) and the old -> new token index map (B, N)
+    B, N, _ = metric.shape
+    r = min(r, (N - 1) // 2)
+    metric = F.normalize(metric, dim=-1)
+    a, b = metric[:, ::2], metric[:, 1::2]
+    scores = torch.matmul(a, b.transpose(1, 2))  # (B, Na, Nb)
+    scores[:, 0, :] = float('-inf')
+
+    node_max, node_idx = scores.max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)
+    unm_idx = edge_idx[:, r:].sort(dim=-1)[0]  # unmerged A tokens, in order, so the cls token stays first
+    src_idx = edge_idx[:, :r]
+    dst_idx = node_idx.gather(1, src_idx)
+    num_unm = unm_idx.shape[1]
+
+    def merge(x, size):
+        # size-weighted average, so a token standing for many patches keeps its weight in later merges
+        C = x.shape[-1]
+        x = x * size
+        x_a, x_b = x[:, ::2], x[:, 1::2]
+        size_a, size_b = size[:, ::2], size[:, 1::2]
+        x_b = x_b.scatter_add(1, dst_idx.unsqueeze(-1).expand(-1, -1, C),
+                              x_a.gather(1, src_idx.unsqueeze(-1).expand(-1, -1, C)))
+        size_b = size_b.scatter_add(1, dst_idx.unsqueeze(-1), size_a.gather(1, src_idx.unsqueeze(-1)))
+        x = torch.cat((x_a.gather(1, unm_idx.unsqueeze(-1).expand(-1, -1, C)), x_b), dim=1)
+        size = torch.cat((size_a.gather(1, unm_idx.unsqueeze(-1)), size_b), dim=1)
+        return x / size, size
+
+    # new position of every current token: kept A tokens first, then B, merged A tokens point at their B token
+    new_index = torch.empty((B, N), dtype=torch.long, device=metric.device)
+    batch_rows = torch.arange(B, device=metric.device).unsqueeze(1)
+    new_index[batch_rows, unm_idx * 2] = torch.arange(num_unm, device=metric.device).expand(B, -1)
+    new_index[batch_rows, src_idx * 2] = num_unm + dst_idx
+    new_index[:, 1::2] = num_unm + torch.arange(N // 2, device=metric.device)
+    return merge, new_index
+
+
+def merge_schedule(num_blocks, num_patches, keep_ratio=0.9):
+    # tokens removed after each block, keep_ratio: fraction of the patch tokens each block keeps,
+    # one value for all blocks or one per block (1.0 leaves a block alone)
+    keep_ratios = keep_ratio if isinstance(keep_ratio, (list, tuple)) else [keep_ratio] * num_blocks
+    assert len(keep_ratios) == num_blocks, 'need one keep ratio per block'
+    schedule = []
+    for keep in keep_ratios:
+        r = min(int(round(num_patches * (1 - keep))), num_patches // 2)
+        schedule.append(r)
+        num_patches -= r
+    return schedule
+
+
+class TokenMergeEncoder(nn.Module):
+    # Inference wrapper of an EncoderViT (plain or plus) that merges similar patch tokens between the ViT blocks,
+    # white sketch background collapses into a few tokens. The plus recycling head pools fixed spans of the
+    # 196 patch tokens, so its input is unmerged first: every patch gets the feature of the token it went into
+    def __init__(self, model, keep_ratio=0.9):
+        super().__init__()
+        self.model = model
+        self.schedule = merge_schedule(len(model.encoder.blocks), model.encoder.patch_embed.num_patches, keep_ratio)
+
+    def embedding(self, image):
+        encoder = self.model.encoder
+        x = encoder.patch_embed(image)
+        cls_token = encoder.cls_token.expand(x.shape[0], -1, -1)
+        if encoder.dist_token is None:
+            x = torch.cat((cls_token, x), dim=1)
+        else:
+            x = torch.cat((cls_token, encoder.dist_token.expand(x.shape[0], -1, -1), x), dim=1)
+        x = encoder.pos_drop(x + encoder.pos_embed)
+
+        # source[b, i]: current token that input token i was merged into
+        source = torch.arange(x.shape[1], device=x.device).expand(x.shape[0], -1)
+        size = x.new_ones(x.shape[0], x.shape[1], 1)
+        for block, r in zip(encoder.blocks, self.schedule):
+            x = block(x)
+            if r > 0:
+                merge, new_index = bipartite_soft_matching(x, r)
+                x, size = merge(x, size)
+                source = new_index.gather(1, source)
+        return encoder.norm(x), source
+
+    def forward(self, image):
+        vit_feat, source = self.embedding(image)
+        if hasattr(self.model, 'recycle_model'):
+            vit_feat = vit_feat.gather(1, source.unsqueeze(-1).expand(-1, -1, vit_feat.shape[-1]))
+            return self.model.head(vit_feat), vit_feat
+        return self.model.mlp_head(vit_feat[:, 0]), vit_feat
+
+
+def images_per_second(model, images, iters=10, warmup=2):
+    # the merge schedule is fixed but the matching follows the content, time it on real images
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(images)
+        if images.is_cuda:
+            torch.cuda.synchronize(images.device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(images)
+        if images.is_cuda:
+            torch.cuda.synchronize(images.device)
+    return len(images) * iters / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    from torch.utils.data import DataLoader
+    from data_loader import LoadDatasetSkt, LoadDatasetImg
+    from image_cache import eval_transform
+    from embed import load_encoder
+
+    parser = argparse.ArgumentParser(description='Accuracy vs throughput of token merging in the ViT trunk')
+    parser.add_argument('--checkpoint', type=str, required=True, help='train_main(_plus).py checkpoint')
+    parser.add_argument('--dataset', type=str, default='ClothesV1', help='ClothesV1, ChairV2, ShoeV2')
+    parser.add_argument('--model', type=str, default='auto', help='auto, vit, plus')
+    parser.add_argument('--num_classes', type=int, default=512, help='num classes')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ouput feature dim')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 7], help='token recycling scales')
+    parser.add_argument('--keep_ratios', type=float, nargs='+', default=[1.0, 0.95, 0.9, 0.85, 0.8],
+                        help='per-block keep ratios to sweep')
+    parser.add_argument('--modality', type=str, nargs='+', default=['sketch', 'photo'], help='encoders to merge')
+    parser.add_argument('--batch_size', type=int, default=32, help='throughput batch size')
+    parser.add_argument('--device', type=str, default='cuda', help='device')
+    args = parser.parse_args()
+
+    models = {modality: load_encoder(args.checkpoint, modality=modality, model=args.model,
+                                     num_classes=args.num_classes, feature_dim=args.feature_dim,
+                                     scales=args.scales, device=args.device)
+              for modality in ['sketch', 'photo']}
+    if hasattr(models['sketch'], 'recycle_model'):
+        from train_plus_utils import get_acc
+    else:
+        from train_utils import get_acc
+
+    # throughput on one batch of test sketches / photos of the first merged encoder
+    LoadDataset = LoadDatasetSkt if args.modality[0] == 'sketch' else LoadDatasetImg
+    data_set = LoadDataset(img_folder_path='./datasets/{}/testB/'.format(args.dataset),
+                           skt_folder_path='./datasets/{}/testA/'.format(args.dataset), transform=eval_transform())
+    images = next(iter(DataLoader(data_set, batch_size=args.batch_size, shuffle=True)))
+    images = (images[0] if args.modality[0] == 'sketch' else images).to(args.device)
+
+    results = []
+    for keep_ratio in args.keep_ratios:
+        merged = {modality: TokenMergeEncoder(model, keep_ratio) if modality in args.modality else model
+                  for modality, model in models.items()}
+        throughput = images_per_second(merged[args.modality[0]], images)
+        accs = get_acc(merged['sketch'], merged['photo'], dataset=args.dataset, mode='test', device=args.device)
+        num_patches = models['sketch'].encoder.patch_embed.num_patches
+        tokens = num_patches - sum(merge_schedule(len(models['sketch'].encoder.blocks), num_patches, keep_ratio))
+        results.append((keep_ratio, tokens, throughput, accs))
+
+    print('keep ratio | final patch tokens | {} img/s | top1 / top5 / top10'.format(args.modality[0]))
+    for keep_ratio, tokens, throughput, accs in results:
+        print('{:>10} | {:>18} | {:>10.1f} | {} / {} / {}'.format(keep_ratio, tokens, throughput, *accs))
@@ -0,0 +1,393 @@
+import os
+import random
+from functools import partial
+import numpy as np
+import torch
+import wandb
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from tqdm import tqdm
+
+from train_utils import multi_cross_loss, embed_views
+from batch_augment import BatchAugment
+from memory_queue import FeatureQueue, MomentumEncoder, queue_cross_loss
+from grad_cache import grad_cache_step
+from fast_vit import use_sdpa, compile_embedding
+from precision import resolve_precision, autocast, with_autocast, make_scaler, StepTimer
+from async_eval import AsyncEvaluator, evaluate_splits
+from distributed import init_distributed, cleanup_distributed, is_main_process, all_gather_features, wrap_ddp
+
+
+def add_train_args(parser):
+    # the flags shared by train_main.py and train_main_plus.py
+    parser.add_argument('--dataset', default='ChairV2', help='ClothesV1, ChairV2, ShoeV2')
+    parser.add_argument('--num_classes', type=int, default=512, help='num classes')
+    parser.add_argument('--feature_dim', type=int, default=768, help='ouput feature dim')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--batch_size', type=int, default=16, help='data loader batch size')
+    parser.add_argument('--num_workers', type=int, default=4, help='data loader num workers')
+    parser.add_argument('--num_epochs', type=int, default=500, help='training epochs')
+    parser.add_argument('--save_iter', type=int, default=100, help='the training iter to save model')
+    parser.add_argument('--lr', type=float, default=6e-6, help='init learning rate')
+    parser.add_argument('--weight_decay', type=float, default=1e-4, help='learning rate weight decay')
+    parser.add_argument('--best_top1_acc', type=float, default=0.0, help='the best training Top1 acc')
+    parser.add_argument('--best_top5_acc', type=float, default=0.0, help='the best training Top5 acc')
+    parser.add_argument('--best_top10_acc', type=float, default=0.0, help='the best training Top10 acc')
+    parser.add_argument('--temperature', type=float, default=0.07, help='softmax temperature')
+    parser.add_argument('--precision', type=str, default='fp16', choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision (fp16 falls back to fp32 off CUDA)')
+    parser.add_argument('--shuffle', type=bool, default=True, help='if shuffle datasets')
+    parser.add_argument('--device', type=str, default='cuda:0', help='training device')
+    parser.add_argument('--n-views', type=int, default=2, help='Number of views for contrastive learning.')
+    parser.add_argument('--checkpoint', type=str, default=None, help='pretrained model checkpoint path')
+    parser.add_argument('--image_cache', type=str, default=None, help='decoded image cache dir (e.g. ./image_cache)')
+    parser.add_argument('--batch_aug', action='store_true', help='build the augmented views batched on the device')
+    parser.add_argument('--fuse_views', action='store_true', help='encode anchor and augmented views in one pass')
+    parser.add_argument('--share_weights', action='store_true', help='one encoder for both sketches and images')
+    parser.add_argument('--queue_size', type=int, default=0, help='queued negatives per modality (0 disables)')
+    parser.add_argument('--micro_batch', type=int, default=0, help='GradCache micro-batch size (0 disables)')
+    parser.add_argument('--grad_checkpointing', action='store_true', help='recompute ViT blocks in backward')
+    parser.add_argument('--sdpa', action='store_true', help='fused scaled_dot_product_attention in the ViT blocks')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the ViT trunk')
+    parser.add_argument('--momentum', type=float, default=0.0, help='key encoder momentum, e.g. 0.999 (0 disables)')
+    parser.add_argument('--eval_every', type=int, default=1, help='evaluate every n epochs (and after the last)')
+    parser.add_argument('--eval_train_queries', type=int, default=None, help='sketch queries sampled from train split')
+    parser.add_argument('--async_eval', action='store_true', help='evaluate in a background process while training')
+    parser.add_argument('--eval_device', type=str, default=None, help='device of the background evaluation')
+    parser.add_argument('--dist_backend', type=str, default=None, help='nccl or gloo (default by device)')
+    parser.add_argument('--dist_timeout', type=int, default=180, help='collective timeout in minutes')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def train_paths(dataset, checkpoint_suffix=''):
+    # photo folder, sketch folder of the train split and the checkpoint dir
+    if dataset not in ['ClothesV1', 'ChairV2', 'ShoeV2']:
+        raise ValueError('Dataset Name Error !')
+    return ('./datasets/{}/trainB/'.format(dataset), './datasets/{}/trainA/'.format(dataset),
+            './checkpoint/{}{}/'.format(dataset, checkpoint_suffix))
+
+
+def init_training(args, save_path):
+    init_distributed(args)
+
+    # rank 0 logs, evaluates and saves checkpoints
+    wandb.init(project='FGSBIR',
+               config=args, mode=None if is_main_process() else 'disabled')
+    os.makedirs(save_path, exist_ok=True)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed(args.seed)
+    torch.cuda.manual_seed_all(args.seed)
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+
+
+def make_train_loader(args, train_set):
+    train_sampler = DistributedSampler(train_set, shuffle=args.shuffle, seed=args.seed) if args.distributed else None
+    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=args.shuffle and train_sampler is None,
+                              sampler=train_sampler, num_workers=args.num_workers, pin_memory=True)
+
+    print('Dataset: {}  |  Batch size: {}\n'
+          .format(args.dataset, args.batch_size))
+    return train_loader, train_sampler
+
+
+def load_checkpoint(args, img_model, skt_model):
+    # -> epoch of args.checkpoint, 0 without one
+    if args.checkpoint is None:
+        return 0
+
+    checkpoint = torch.load(args.checkpoint)
+    print('Loading Pretrained model successful !'
+          'Epoch:[{}]  |  Loss:[{}]'.format(checkpoint['epoch'], checkpoint['loss']))
+    if 'top1' in checkpoint:
+        print('Top1: {} %  |  Top5: {} %  |  Top10: {} %'.format(checkpoint['top1'], checkpoint['top5'],
+                                                                 checkpoint['top10']))
+    img_model.load_state_dict(checkpoint['img_model'])
+    skt_model.load_state_dict(checkpoint['skt_model'])
+    return checkpoint['epoch']
+
+
+def checkpoint_state(img_state, skt_state, epoch, loss, accuracies=None):
+    save_state = {'img_model': img_state,
+                  'skt_model': skt_state,
+                  'epoch': epoch,
+                  'loss': loss}
+    if accuracies is not None:
+        save_state.update(accuracies)
+    return save_state
+
+
+class ContrastiveTrainer:
+    # The training / evaluation loop of train_main.py (ViT_backbone.EncoderViT) and train_main_plus.py
+    # (train_plus_utils.EncoderViT, whose recycling head adds a decorrelation loss); the scripts build the
+    # models and keep their own best-checkpoint policy
+    def __init__(self, args, img_model, skt_model, get_acc, model_fn, model_kwargs):
+        self.args = args
+        self.img_model = img_model
+        self.skt_model = skt_model
+        self.get_acc = get_acc
+        self.model_fn = model_fn
+        self.model_kwargs = model_kwargs
+        self.plus = hasattr(img_model, 'recycle_model')
+        # accuracies of the latest finished evaluation, for the periodic checkpoints
+        self.last_eval = None
+
+        img_model.to(args.device)
+        skt_model.to(args.device)
+        img_model.set_grad_checkpointing(args.grad_checkpointing)
+        skt_model.set_grad_checkpointing(args.grad_checkpointing)
+        if args.sdpa:
+            use_sdpa(img_model)
+            use_sdpa(skt_model)
+
+        self.batch_augment = BatchAugment(im_size=args.image_size).to(args.device) if args.batch_aug else None
+
+        # cross-batch negatives: queued keys of past batches, optionally from momentum key encoders
+        self.skt_queue, self.img_queue, self.skt_key_model, self.img_key_model = None, None, None, None
+        if args.queue_size > 0:
+            self.skt_queue = FeatureQueue(args.num_classes, args.queue_size).to(args.device)
+            self.img_queue = FeatureQueue(args.num_classes, args.queue_size).to(args.device)
+            if args.momentum > 0:
+                self.img_key_model = MomentumEncoder(img_model, args.momentum).to(args.device)
+                self.skt_key_model = self.img_key_model if skt_model is img_model else \
+                    MomentumEncoder(skt_model, args.momentum).to(args.device)
+
+        # compiled after the momentum copies are taken, which stay eager
+        if args.compile:
+            compile_embedding(img_model)
+            if skt_model is not img_model:
+                compile_embedding(skt_model)
+
+        # autocast around the encoders and losses, loss scaling only for fp16
+        args.precision = resolve_precision(args.precision, args.device)
+        self.scaler = make_scaler(args.precision, args.device)
+        param_groups = [{"params": img_model.parameters()}]
+        if skt_model is not img_model:
+            param_groups.append({"params": skt_model.parameters()})
+        self.optimizer = torch.optim.Adam(param_groups, args.lr, weight_decay=args.weight_decay)
+
+        # the encoders run inside one (DDP) module call per step so gradients are synced across ranks
+        self.step_module = wrap_ddp(args, img_model=img_model, skt_model=skt_model)
+
+    def head(self, model, vit_feat):
+        # (mlp feature,) of the plain head, (mlp feature, decorrelation loss) of the recycling head
+        if self.plus:
+            return model.head(vit_feat, trainable=True)
+        return model.mlp_head(vit_feat[:, 0]),
+
+    def anchor_forward(self, model, anchor):
+        if self.plus:
+            mlp_feat, vit_feat, decorrelation_loss = model(anchor, trainable=True)
+            return (mlp_feat, decorrelation_loss), vit_feat
+        mlp_feat, vit_feat = model(anchor)
+        return (mlp_feat,), vit_feat
+
+    def encode_views(self, skt_anchor, skt_aug, img_anchor, img_aug):
+        # -> skt mlp / cls / aug, img mlp / cls / aug features (+ skt, img decorrelation losses of the plus model)
+        skt_model, img_model = self.skt_model, self.img_model
+
+        # 1.1.1 anchor features
+        if self.args.fuse_views:
+            (skt_vit_feat, skt_aug_feat), (img_vit_feat, img_aug_feat) = embed_views(
+                skt_model, img_model, (skt_anchor, skt_aug), (img_anchor, img_aug))
+            # the recycle head only sees the anchors, as in the unfused step
+            skt_head = self.head(skt_model, skt_vit_feat)
+            img_head = self.head(img_model, img_vit_feat)
+            skt_aug_feat, img_aug_feat = skt_aug_feat[:, 0], img_aug_feat[:, 0]
+        else:
+            skt_head, skt_vit_feat = self.anchor_forward(skt_model, skt_anchor)
+            img_head, img_vit_feat = self.anchor_forward(img_model, img_anchor)
+
+            # 1.1.2 augmented view features
+            skt_aug_feat = skt_model.embedding(skt_aug)[:, 0]
+            img_aug_feat = img_model.embedding(img_aug)[:, 0]
+
+        return (skt_head[0], skt_vit_feat[:, 0], skt_aug_feat, img_head[0], img_vit_feat[:, 0], img_aug_feat) + \
+            skt_head[1:] + img_head[1:]
+
+    def compute_loss(self, skt_mlp_feat, skt_cls_feat, skt_aug_feat, img_mlp_feat, img_cls_feat, img_aug_feat,
+                     *decorrelation_losses, skt_key=None, img_key=None):
+        args = self.args
+        # negatives from every rank
+        skt_mlp_feat, skt_cls_feat, skt_aug_feat, img_mlp_feat, img_cls_feat, img_aug_feat = [
+            all_gather_features(feat)
+            for feat in (skt_mlp_feat, skt_cls_feat, skt_aug_feat, img_mlp_feat, img_cls_feat, img_aug_feat)]
+        skt_key = None if skt_key is None else all_gather_features(skt_key)
+        img_key = None if img_key is None else all_gather_features(img_key)
+
+        # main, self (skt / img) and contrastive InfoNCE terms in one batched call
+        cross_losses = list(multi_cross_loss([(skt_mlp_feat, img_mlp_feat),
+                                              (skt_aug_feat, skt_cls_feat),
+                                              (img_aug_feat, img_cls_feat),
+                                              (skt_cls_feat, img_cls_feat)], args))
+
+        if self.img_queue is not None:
+            # main loss with the queued keys of the other modality as extra negatives
+            skt_key = skt_mlp_feat if skt_key is None else skt_key
+            img_key = img_mlp_feat if img_key is None else img_key
+            cross_losses[0] = (queue_cross_loss(skt_mlp_feat, img_key, self.img_queue, args) +
+                               queue_cross_loss(img_mlp_feat, skt_key, self.skt_queue, args)) / 2
+
+        loss = cross_losses[0] + (cross_losses[1] + cross_losses[2]) + cross_losses[3]
+        if decorrelation_losses:
+            # per micro-batch values under GradCache, averaged
+            skt_decorrelation_loss, img_decorrelation_loss = decorrelation_losses
+            cross_losses.append(skt_decorrelation_loss.mean() + img_decorrelation_loss.mean())
+            loss = loss + cross_losses[4]
+        return loss, cross_losses, skt_key, img_key
+
+    def train_epoch(self, train_loader, train_sampler, epoch):
+        # -> summed contrastive loss of the epoch
+        args = self.args
+        epoch_train_contrastive_loss = 0
+        epoch_cross_loss_anchor = 0
+        epoch_cross_loss_self = 0
+        epoch_cross_loss_triple = 0
+        epoch_cross_loss_decor = 0
+
+        self.img_model.train()
+        self.skt_model.train()
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        step_timer = StepTimer(args.device)
+
+        # 1.1 training for epochs
+        for batch_idx, data in enumerate(tqdm(train_loader, disable=not is_main_process())):
+            if self.batch_augment is None:
+                skt_anchor, skt_aug, img_anchor, img_aug = data
+                skt_anchor, skt_aug = skt_anchor.to(args.device), skt_aug.to(args.device)
+                img_anchor, img_aug = img_anchor.to(args.device), img_aug.to(args.device)
+            else:
+                skt_anchor, skt_aug = self.batch_augment(data[0].to(args.device, non_blocking=True))
+                img_anchor, img_aug = self.batch_augment(data[1].to(args.device, non_blocking=True))
+
+            self.optimizer.zero_grad()
+
+            # keys of the momentum encoders, outside the graph
+            with autocast(args.precision, args.device):
+                skt_key = None if self.skt_key_model is None else self.skt_key_model(skt_anchor)
+                img_key = None if self.img_key_model is None else self.img_key_model(img_anchor)
+
+            views = skt_anchor, skt_aug, img_anchor, img_aug
+            encode = with_autocast(partial(self.step_module, self.encode_views), args.precision, args.device)
+            loss_fn = with_autocast(partial(self.compute_loss, skt_key=skt_key, img_key=img_key),
+                                    args.precision, args.device)
+            if args.micro_batch > 0:
+                # GradCache: the loss sees the whole batch, the encoders only one micro-batch at a time
+                # under DDP only the last micro-batch replay all-reduces the gradients
+                loss, cross_losses, skt_key, img_key = grad_cache_step(
+                    encode, views, loss_fn, args.micro_batch, self.scaler,
+                    no_sync=self.step_module.no_sync if args.distributed else None)
+            else:
+                loss, cross_losses, skt_key, img_key = loss_fn(*encode(*views))
+                self.scaler.scale(loss).backward()
+
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            step_timer.step(len(skt_anchor) * args.world_size)
+
+            if self.img_queue is not None:
+                if self.img_key_model is not None:
+                    self.img_key_model.update(self.img_model)
+                if self.skt_key_model is not None and self.skt_key_model is not self.img_key_model:
+                    self.skt_key_model.update(self.skt_model)
+                self.skt_queue.enqueue(skt_key)
+                self.img_queue.enqueue(img_key)
+
+            epoch_train_contrastive_loss = epoch_train_contrastive_loss + loss.item()
+            epoch_cross_loss_anchor = epoch_cross_loss_anchor + cross_losses[0].item()
+            epoch_cross_loss_self = epoch_cross_loss_self + (cross_losses[1] + cross_losses[2]).item()
+            epoch_cross_loss_triple = epoch_cross_loss_triple + cross_losses[3].item()
+            if self.plus:
+                epoch_cross_loss_decor = epoch_cross_loss_decor + cross_losses[4].item()
+
+        steps_per_second, samples_per_second = step_timer.rates()
+        print('Epoch Train: [{}] Contrastive Loss: {}'.format(epoch, epoch_train_contrastive_loss))
+        print('Epoch Train: [{}] {}: {:.3f} steps/s, {:.1f} samples/s'.format(epoch, args.precision, steps_per_second,
+                                                                            samples_per_second))
+        wandb.log({'Steps Per Second': steps_per_second}, step=epoch)
+        wandb.log({'Samples Per Second': samples_per_second}, step=epoch)
+        wandb.log({'Contrastive Loss': epoch_train_contrastive_loss}, step=epoch)
+        wandb.log({'Cross Loss Anchor': epoch_cross_loss_anchor}, step=epoch)
+        wandb.log({'Self Loss': epoch_cross_loss_self}, step=epoch)
+        wandb.log({'Triple Loss': epoch_cross_loss_triple}, step=epoch)
+        if self.plus:
+            wandb.log({'Decor Loss': epoch_cross_loss_decor}, step=epoch)
+        return epoch_train_contrastive_loss
+
+    def fit(self, train_loader, train_sampler, start_epoch, end_epoch, save_best, save_periodic=None):
+        # save_best(eval_epoch, eval_loss, (top1, top5, top10), img_state, skt_state): rank 0, after every
+        # evaluation, with the evaluated weights; save_periodic(epoch, loss): every rank, after every epoch
+        args = self.args
+
+        # evaluation every eval_every epochs, optionally in a background process on eval_device
+        eval_kwargs = dict(batch_size=128, dataset=args.dataset, device=args.device, image_cache_dir=args.image_cache,
+                           train_queries=args.eval_train_queries)
+        evaluator = None
+        if args.async_eval and is_main_process():
+            evaluator = AsyncEvaluator(self.model_fn, self.model_kwargs, self.get_acc,
+                                       **dict(eval_kwargs, device=args.eval_device or args.device))
+
+        for epoch in range(start_epoch + 1, end_epoch + 1):
+            wandb.log({'Progress': epoch}, step=epoch)
+            epoch_train_contrastive_loss = self.train_epoch(train_loader, train_sampler, epoch)
+
+            # 1.2 test for accuracy, here or in the background evaluator
+            eval_results = []
+            if epoch % args.eval_every == 0 or epoch == end_epoch:
+                if evaluator is not None:
+                    evaluator.submit(epoch, round(epoch_train_contrastive_loss, 5), self.skt_model, self.img_model)
+                elif not args.async_eval:
+                    self.img_model.eval()
+                    self.skt_model.eval()
+                    with torch.no_grad():
+                        print('Testing for dataset accuracy...')
+                        eval_results.append((epoch, round(epoch_train_contrastive_loss, 5),
+                                             evaluate_splits(self.get_acc, self.skt_model, self.img_model,
+                                                             sharded=args.distributed, **eval_kwargs), None))
+            if evaluator is not None:
+                eval_results += evaluator.poll(wait=epoch == end_epoch)
+
+            for eval_epoch, eval_loss, (test_acc, train_acc), eval_state in eval_results:
+                top1_accuracy, top5_accuracy, top10_accuracy = test_acc
+                self.last_eval = {'eval_epoch': eval_epoch, 'top1': top1_accuracy, 'top5': top5_accuracy,
+                                  'top10': top10_accuracy}
+                top1_acc_train, top5_acc_train, top10_acc_train = train_acc
+                print('Epoch Test: [{}]'.format(eval_epoch))
+                print('Top1: {:.3f} %  |  Top5: {:.3f} %  |  Top10: {:.3f} %'.format(top1_accuracy,
+                                                                                     top5_accuracy,
+                                                                                     top10_accuracy))
+                print('Top1: {:.3f} %  |  Top5: {:.3f} %  |  Top10: {:.3f} %'.format(top1_acc_train,
+                                                                                     top5_acc_train,
+                                                                                     top10_acc_train))
+                wandb.log({'Eval Epoch': eval_epoch}, step=epoch)
+                wandb.log({'Top1 Acc': top1_accuracy}, step=epoch)
+                wandb.log({'Top5 Acc': top5_accuracy}, step=epoch)
+                wandb.log({'Top10 Acc': top10_accuracy}, step=epoch)
+                wandb.log({'Top1 Acc Train': top1_acc_train}, step=epoch)
+                wandb.log({'Top5 Acc Train': top5_acc_train}, step=epoch)
+                wandb.log({'Top10 Acc Train': top10_acc_train}, step=epoch)
+
+                # 1.3 save checkpoints (of the evaluated weights)
+                if not is_main_process():
+                    continue
+
+                img_state, skt_state = eval_state if eval_state is not None else \
+                    (self.img_model.state_dict(), self.skt_model.state_dict())
+                save_best(eval_epoch, eval_loss, test_acc, img_state, skt_state)
+
+            if save_periodic is not None:
+                save_periodic(epoch, round(epoch_train_contrastive_loss, 5))
+
+        print('Best Acc:\nTop1: {:.3f} %  |  Top5: {:.3f} %  |  Top10: {:.3f} %'.format(args.best_top1_acc,
+                                                                                        args.best_top5_acc,
+                                                                                        args.best_top10_acc))
+
+        if evaluator is not None:
+            evaluator.close()
+        wandb.finish()
+        cleanup_distributed()
@@ -4,8 +4,8 @@ Acknowledgements:
 """
 
 import os
-import glob
 import random
+import warnings
 import numpy as np
 from torch import nn
 import timm
@@ -15,9 +15,15 @@ import torch
 from tqdm import tqdm
 from PIL import Image
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
-from torchvision.transforms import Compose, Resize, ToTensor
+from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.checkpoint import checkpoint
 from torchvision import transforms
+from gallery_index import get_gallery_features
+from dataset_index import load_dataset_index
+from image_cache import load_image_cache, open_image, eval_transform
+from retrieval import encode_features, target_rank, topk_accuracy
+from distributed import encode_sharded, shard_slice, reduce_topk_accuracy
+from train_utils import cross_loss, multi_cross_loss
 
 
 # # Swin-ViT
@@ -86,7 +92,8 @@ from torchvision import transforms
 
 # # ViT
 class EncoderViT(nn.Module):
-    def __init__(self, num_classes=256, feature_dim=768, encoder_backbone='vit_base_patch16_224', device='cuda'):
+    def __init__(self, num_classes=256, feature_dim=768, encoder_backbone='vit_base_patch16_224', scales=[1, 2, 7],
+                 overlap_target=False):
         super().__init__()
         self.encoder: VisionTransformer = timm.create_model(encoder_backbone, pretrained=True)
         self.mlp_head = nn.Sequential(
@@ -99,7 +106,13 @@ class EncoderViT(nn.Module):
                 if m.bias is not None:
                     m.bias.data.zero_()
 
-        self.recycle_model = MultiScaleTransformer(scales=[1, 2, 7], device=device)
+        self.recycle_model = MultiScaleTransformer(input_dim=feature_dim, scales=scales,
+                                                   num_patches=self.encoder.patch_embed.num_patches,
+                                                   overlap_target=overlap_target)
+        self.grad_checkpointing = False
+
+    def set_grad_checkpointing(self, enable=True):
+        self.grad_checkpointing = enable
 
     def embedding(self, image):
         x = self.encoder.patch_embed(image)
@@ -109,22 +122,32 @@ class EncoderViT(nn.Module):
         else:
             x = torch.cat((cls_token, self.encoder.dist_token.expand(x.shape[0], -1, -1), x), dim=1)
         x = self.encoder.pos_drop(x + self.encoder.pos_embed)
-        x = self.encoder.blocks(x)
+        if self.grad_checkpointing and torch.is_grad_enabled():
+            # keep only the block inputs, recompute each block in backward
+            for block in self.encoder.blocks:
+                x = checkpoint(block, x, use_reentrant=False)
+        else:
+            x = self.encoder.blocks(x)
         x = self.encoder.norm(x)
         return x
 
+    def head(self, vit_feat, trainable=False):
+        if trainable:
+            recycle_feat, decorrelation_loss = self.recycle_model(vit_feat, trainable)
+            return self.mlp_head(recycle_feat), decorrelation_loss
+
+        return self.mlp_head(self.recycle_model(vit_feat, trainable))
+
     def forward(self, image, trainable=False):
         vit_feat = self.embedding(image)
 
         if trainable:
-            recycle_feat, decorrelation_loss = self.recycle_model(vit_feat, trainable)
-            mlp_feat = self.mlp_head(recycle_feat)
+            mlp_feat, decorrelation_loss = self.head(vit_feat, trainable)
 
             return mlp_feat, vit_feat, decorrelation_loss
 
         else:
-            recycle_feat = self.recycle_model(vit_feat, trainable)
-            mlp_feat = self.mlp_head(recycle_feat)
+            mlp_feat = self.head(vit_feat, trainable)
 
             return mlp_feat, vit_feat
 
@@ -144,31 +167,94 @@ class TransformerEncoder(nn.Module):
 
 
 class MultiScaleTransformer(nn.Module):
-    def __init__(self, input_dim=768, num_heads=8, scales=[1, 2, 7], device='cuda'):
+    def __init__(self, input_dim=768, num_heads=8, scales=[1, 2, 7], num_patches=196, concurrent=True,
+                 overlap_target=False):
         super(MultiScaleTransformer, self).__init__()
-        self.transformer_models = [TransformerEncoder(input_dim=input_dim, num_heads=num_heads,
-                                                      num_layers=2).to(device)
-                                   for _ in scales]
-        self.scales = scales
-        self.fc = nn.Linear(196 + 49 + 4, 1)
+        for scale in scales:
+            assert num_patches % (scale * scale) == 0, 'scale {} does not tile {} patches'.format(scale, num_patches)
+
+        self.transformer_models = nn.ModuleList([TransformerEncoder(input_dim=input_dim, num_heads=num_heads,
+                                                                    num_layers=2)
+                                                 for _ in scales])
+        self.scales = list(scales)
+        self.num_patches = num_patches
+        self.num_tokens = [num_patches // (scale * scale) for scale in self.scales]  # 196 + 49 + 4 for ViT-B/16
+        # decorrelation target from the overlap rule for every layout, see contrast_matrix
+        self.overlap_target = overlap_target
+        # run the per-scale encoders on separate CUDA streams
+        self.concurrent = concurrent
+        self.fc = nn.Linear(sum(self.num_tokens), 1)
         # self.weight = nn.Parameter(torch.tensor(0.1))
         self.weight = 0.1
 
+        # per-device CUDA streams of the scales, created on first use
+        self.streams = {}
+
+        # constant decorrelation target, built once and moved along with the module
+        self.register_buffer('contrast_target', self.contrast_matrix(), persistent=False)
+
+        # Checkpoints of the original code carry no transformer_models.* weights (the encoders were a plain list,
+        # so they were never saved). Loading one is an error unless allow_missing_encoders is set, which keeps
+        # the encoders at their random init, as the original code did.
+        self.allow_missing_encoders = False
+        self.register_load_state_dict_post_hook(self.drop_missing_encoders)
+
+    @staticmethod
+    def drop_missing_encoders(module, incompatible_keys):
+        missing = [key for key in incompatible_keys.missing_keys if 'transformer_models.' in key]
+        if not missing:
+            return
+        if not module.allow_missing_encoders:
+            print('MultiScaleTransformer: {} encoder weights not in checkpoint, set allow_missing_encoders '
+                  '(--allow_missing_mstr) to load it with randomly initialized encoders'.format(len(missing)))
+            return
+        warnings.warn('MultiScaleTransformer: {} encoder weights not in checkpoint, '
+                      'keeping their random init'.format(len(missing)))
+        for key in missing:
+            incompatible_keys.missing_keys.remove(key)
+
+    def __getstate__(self):
+        # streams are per process, deep copies and pickles start without them
+        state = self.__dict__.copy()
+        state['streams'] = {}
+        return state
+
+    def cuda_streams(self, device):
+        if device not in self.streams:
+            self.streams[device] = [torch.cuda.Stream(device) for _ in self.scales]
+        return self.streams[device]
+
+    def scale_tokens(self, patch_tokens, scale):
+        if scale == 1:
+            return patch_tokens
+        B, N, C = patch_tokens.size()
+        return patch_tokens.view(B, N // (scale * scale), scale, scale, C).mean(dim=(2, 3))
+
+    def encode_scales(self, patch_tokens):
+        if not (self.concurrent and patch_tokens.is_cuda and len(self.scales) > 1):
+            return [transformer(self.scale_tokens(patch_tokens, scale))  # (B, new_size, 768)
+                    for scale, transformer in zip(self.scales, self.transformer_models)]
+
+        # the scales are independent, so each one gets its own stream and the small 49 / 4 token encoders
+        # overlap with the 196 token one instead of queueing behind it
+        current_stream = torch.cuda.current_stream(patch_tokens.device)
+        streams = self.cuda_streams(patch_tokens.device)
+        multi_scale_features = []
+        for scale, transformer, stream in zip(self.scales, self.transformer_models, streams):
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                patch_tokens.record_stream(stream)
+                multi_scale_features.append(transformer(self.scale_tokens(patch_tokens, scale)))
+        for stream, features in zip(streams, multi_scale_features):
+            current_stream.wait_stream(stream)
+            features.record_stream(current_stream)
+        return multi_scale_features
+
     def forward(self, vit_features, trainable=False):
         cls_token = vit_features[:, 0, :]  # (B, 768)
         patch_tokens = vit_features[:, 1:, :]  # (B, 196, 768)
 
-        multi_scale_features = []
-        for scale, transformer in zip(self.scales, self.transformer_models):
-            if scale != 1:
-                B, N, C = patch_tokens.size()
-                new_size = int(N / (scale * scale))
-                patch_tokens_scaled = patch_tokens.view(B, new_size, scale, scale, C)
-                patch_tokens_scaled = patch_tokens_scaled.mean(dim=(2, 3))
-            else:
-                patch_tokens_scaled = patch_tokens
-            enhanced_patch_tokens = transformer(patch_tokens_scaled)  # (B, new_size, 768)
-            multi_scale_features.append(enhanced_patch_tokens)
+        multi_scale_features = self.encode_scales(patch_tokens)
 
         combined_features = torch.cat(multi_scale_features, dim=1)  # (B, 196 + 49 + 4, 768)
 
@@ -181,50 +267,37 @@ class MultiScaleTransformer(nn.Module):
 
             similarity_matrix = torch.matmul(pooled_features, pooled_features.transpose(-1, -2))  # (B, 249, 249)
 
-            identity_matrix = self.contrast_matrix(similarity_matrix.size(-1)).to(similarity_matrix.device)
-            identity_matrix = identity_matrix.unsqueeze(0).expand(similarity_matrix.size(0), -1, -1)
-            decorrelation_loss = F.mse_loss(similarity_matrix, identity_matrix)
+            # broadcast against the (249, 249) target instead of expanding it per sample
+            decorrelation_loss = (similarity_matrix - self.contrast_target).pow(2).mean()
 
             return final_features, decorrelation_loss
 
         else:
             return final_features
 
-    def contrast_matrix(self, matrix_len):
-        identity_matrix = torch.eye(matrix_len)
-
-        matrix_10 = torch.zeros((49, 196))
-        for i in range(49):
-            matrix_10[i, i*4:(i+1)*4] = 0.5
-
-        matrix_20 = torch.zeros((4, 245))
-        for i in range(4):
-            matrix_20[i, i * 49:(i + 1) * 49] = 0.5
-        for i in range(4):
-            if i != 3:
-                matrix_20[i, 196 + i*12:196 + (i + 1) * 13] = 0.5
-            else:
-                matrix_20[i, 196 + i * 12:] = 0.5
-
-        matrix_01 = torch.zeros((196, 49))
-        for i in range(49):
-            matrix_01[i * 4:(i + 1) * 4, i] = 0.5
-
-        matrix_02 = torch.zeros((245, 4))
-        for i in range(4):
-            matrix_02[i * 49:(i + 1) * 49, i] = 0.5
-        for i in range(4):
-            if i != 3:
-                matrix_20[196 + i * 12:196 + (i + 1) * 13, i] = 0.5
-            else:
-                matrix_20[196 + i * 12:, i] = 0.5
-
-        identity_matrix[196:245, 0:196] = matrix_10
-        identity_matrix[245:249, 0:245] = matrix_20
-        identity_matrix[0:196, 196:245] = matrix_01
-        identity_matrix[0:245, 245:249] = matrix_02
-
-        # identity_matrix = identity_matrix.numpy()
+    def contrast_matrix(self):
+        # 1 on the diagonal, 0.5 between tokens of different scales that pool overlapping patch tokens
+        # (a scale-s token averages s * s consecutive patch tokens), 0 elsewhere
+        spans = [scale * scale for scale in self.scales]
+        starts = torch.cat([torch.arange(0, self.num_patches, span) for span in spans])
+        ends = torch.cat([torch.arange(span, self.num_patches + 1, span) for span in spans])
+        scale_ids = torch.cat([torch.full((self.num_patches // span,), idx) for idx, span in enumerate(spans)])
+
+        overlap = (starts.unsqueeze(1) < ends.unsqueeze(0)) & (starts.unsqueeze(0) < ends.unsqueeze(1))
+        cross_scale = scale_ids.unsqueeze(1) != scale_ids.unsqueeze(0)
+
+        identity_matrix = 0.5 * (overlap & cross_scale).float()
+        identity_matrix.fill_diagonal_(1.)
+
+        if self.scales == [1, 2, 7] and self.num_patches == 196 and not self.overlap_target:
+            # the original hand-written target, kept bit-for-bit: its scale-2 rows have no scale-7 entries, and
+            # scale-7 token i marks scale-2 tokens 12 * i .. 13 * (i + 1) - 1 (cut at 48), not the overlapping ones.
+            # overlap_target=True keeps the overlap rule here, which differs in 55 entries: 0 -> 0.5 on the 52
+            # overlapping pairs of rows 196-244 x cols 245-248, 0.5 -> 0 at (246, 221), (247, 233), (247, 234)
+            rows = torch.arange(4).unsqueeze(1)
+            cols = torch.arange(49).unsqueeze(0)
+            identity_matrix[196:245, 245:249] = 0.
+            identity_matrix[245:249, 196:245] = 0.5 * ((cols >= 12 * rows) & (cols < 13 * (rows + 1))).float()
 
         return identity_matrix
 
@@ -237,59 +310,46 @@ def get_parameter_number(net):
 
 
 class LoadMyDataset(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, im_size=224):
-        skt_list = []
-        img_list = []
-        # skt_pos_list = []
-        img_name_list = os.listdir(img_folder_path)
-
-        for pos_img_name in img_name_list:
-            # 1.1 anchor_skt_name, pos_skt_name
-            pos_skt_list_path = glob.glob(skt_folder_path + pos_img_name.split('.')[0] + '_?.png')
-            pos_skt_list_name = [file_name.split('/')[-1].split('.')[0] + '.png'
-                                 for file_name in pos_skt_list_path]
-
-            # 1.3 append lists
-            if len(pos_skt_list_name) == 0:
-                print(pos_img_name)
-
-            for len_list in range(len(pos_skt_list_name)):
-                skt_list.append(pos_skt_list_name[len_list])
-                img_list.append(pos_img_name)
-
-            # if len(pos_skt_list_name) == 0:
-            #     continue
-            #
-            # elif len(pos_skt_list_name) == 1:
-            #     skt_list.append(pos_skt_list_name[0])
-            #     img_list.append(pos_img_name)
-            #     skt_pos_list.append(pos_skt_list_name[0])
-            #
-            # else:
-            #     random_idx = random.randint(1, len(pos_skt_list_name) - 1)
-            #     skt_list.append(pos_skt_list_name[0])
-            #     img_list.append(pos_img_name)
-            #     skt_pos_list.append(pos_skt_list_name[random_idx])
+    def __init__(self, img_folder_path, skt_folder_path, im_size=224, cache_dir=None, batch_aug=False):
+        dataset_index = load_dataset_index(img_folder_path, skt_folder_path)
+
+        # 1.1 photos without any sketch
+        for img_idx in np.flatnonzero(np.bincount(dataset_index.skt_to_img,
+                                                  minlength=len(dataset_index.img_list)) == 0):
+            print(dataset_index.img_list[img_idx])
 
         self.img_folder_path = img_folder_path
         self.skt_folder_path = skt_folder_path
 
-        self.skt_list = skt_list
-        self.img_list = img_list
-        # self.skt_pos_list = skt_pos_list
+        # 1.2 (anchor sketch, positive photo) pairs
+        self.skt_list = dataset_index.skt_list
+        self.img_list = [dataset_index.img_list[img_idx] for img_idx in dataset_index.skt_to_img]
+
+        # 1.3 decoded images at their original size, cached once; both views are resized from them
+        self.skt_cache = None
+        self.img_cache = None
+        if cache_dir is not None:
+            self.skt_cache = load_image_cache(skt_folder_path, self.skt_list, cache_dir)
+            self.img_cache = load_image_cache(img_folder_path, dataset_index.img_list, cache_dir)
 
         self.transform_anchor = transforms.Compose([
-            transforms.Resize((im_size, im_size)),
-            transforms.ToTensor()
+            transforms.Resize((im_size, im_size), antialias=True),
+            transforms.ConvertImageDtype(torch.float)
+        ])
+
+        # uint8 anchors only, both views are then built on device by batch_augment.BatchAugment
+        self.batch_aug = batch_aug
+        self.transform_uint8 = transforms.Compose([
+            transforms.Resize((im_size, im_size), antialias=True)
         ])
 
         self.transform_aug = transforms.Compose([
-            transforms.Resize((int(im_size * 1.2), int(im_size * 1.2))),
+            transforms.Resize((int(im_size * 1.2), int(im_size * 1.2)), antialias=True),
             transforms.RandomRotation(30),
             transforms.RandomHorizontalFlip(p=0.8),
             transforms.CenterCrop((int(im_size), int(im_size))),
-            transforms.Resize((im_size, im_size)),
-            transforms.ToTensor()
+            transforms.Resize((im_size, im_size), antialias=True),
+            transforms.ConvertImageDtype(torch.float)
         ])
 
         # self.transform_aug = transforms.Compose([
@@ -301,15 +361,19 @@ class LoadMyDataset(Dataset):
         # ])
 
     def __getitem__(self, item):
+        skt = open_image(self.skt_folder_path, self.skt_list[item], self.skt_cache)
+        img = open_image(self.img_folder_path, self.img_list[item], self.img_cache)
+
+        if self.batch_aug:
+            return self.transform_uint8(skt), self.transform_uint8(img)
+
         # 1.1 anchor skt
-        skt_path = os.path.join(self.skt_folder_path, self.skt_list[item])
-        skt_anchor = self.transform_anchor(Image.fromarray(np.array(Image.open(skt_path).convert('RGB'))))
-        skt_aug = self.transform_aug(Image.fromarray(np.array(Image.open(skt_path).convert('RGB'))))
+        skt_anchor = self.transform_anchor(skt)
+        skt_aug = self.transform_aug(skt)
 
         # 1.2 anchor img
-        pos_path = os.path.join(self.img_folder_path, self.img_list[item])
-        img_anchor = self.transform_anchor(Image.fromarray(np.array(Image.open(pos_path).convert('RGB'))))
-        img_aug = self.transform_aug(Image.fromarray(np.array(Image.open(pos_path).convert('RGB'))))
+        img_anchor = self.transform_anchor(img)
+        img_aug = self.transform_aug(img)
 
         sample = skt_anchor, skt_aug, img_anchor, img_aug
 
@@ -320,27 +384,18 @@ class LoadMyDataset(Dataset):
 
 
 class LoadDatasetSkt(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, transform):
-        skt_list = []
-        label_list = []
-        img_name_list = os.listdir(img_folder_path)
-
-        for img_name in img_name_list:
-            skt_list_path = glob.glob(skt_folder_path + img_name.split('.')[0] + '_?.png')
-            for skt_name in skt_list_path:
-                skt_name = skt_name.split('/')[-1].split('.')[0] + '.png'
-                img_item = img_name_list.index(img_name)
-                skt_list.append(skt_name)
-                label_list.append(img_item)
+    def __init__(self, img_folder_path, skt_folder_path, transform, cache_dir=None):
+        dataset_index = load_dataset_index(img_folder_path, skt_folder_path)
 
         self.skt_folder_path = skt_folder_path
         self.transform = transform
-        self.skt_list = skt_list
-        self.label_list = label_list
+        self.skt_list = dataset_index.skt_list
+        self.label_list = dataset_index.skt_to_img.astype(np.int64)
+        self.skt_cache = None if cache_dir is None else load_image_cache(skt_folder_path, self.skt_list,
+                                                                         cache_dir)
 
     def __getitem__(self, item):
-        skt_path = os.path.join(self.skt_folder_path, self.skt_list[item])
-        sample_skt = self.transform((Image.fromarray(np.array(Image.open(skt_path).convert('RGB')))))
+        sample_skt = self.transform(open_image(self.skt_folder_path, self.skt_list[item], self.skt_cache))
         image_idx = self.label_list[item]
 
         return sample_skt, image_idx
@@ -350,14 +405,15 @@ class LoadDatasetSkt(Dataset):
 
 
 class LoadDatasetImg(Dataset):
-    def __init__(self, img_folder_path, skt_folder_path, transform):
+    def __init__(self, img_folder_path, skt_folder_path, transform, cache_dir=None):
         self.transform = transform
         self.img_folder_path = img_folder_path
-        self.img_list = os.listdir(img_folder_path)
+        self.img_list = load_dataset_index(img_folder_path, skt_folder_path).img_list
+        self.img_cache = None if cache_dir is None else load_image_cache(img_folder_path, self.img_list,
+                                                                         cache_dir)
 
     def __getitem__(self, item):
-        img_path = os.path.join(self.img_folder_path, self.img_list[item])
-        sample_img = self.transform((Image.fromarray(np.array(Image.open(img_path).convert('RGB')))))
+        sample_img = self.transform(open_image(self.img_folder_path, self.img_list[item], self.img_cache))
 
         return sample_img
 
@@ -365,20 +421,27 @@ class LoadDatasetImg(Dataset):
         return len(self.img_list)
 
 
-def get_acc(skt_model, img_model, batch_size=128, dataset='ClothesV1', mode='test', device='cuda'):
+def get_acc(skt_model, img_model, batch_size=128, dataset='ClothesV1', mode='test', device='cuda',
+            index_dir=None, image_cache_dir=None, sharded=False, num_queries=None):
     print('Evaluating Network dataset [{}_{}] ...'.format(dataset, mode))
 
     data_set_skt = LoadDatasetSkt(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform(),
+                                  cache_dir=image_cache_dir)
 
     data_set_img = LoadDatasetImg(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform(),
+                                  cache_dir=image_cache_dir)
 
-    data_loader_skt = DataLoader(data_set_skt, batch_size=batch_size,
-                                 shuffle=True, num_workers=2, pin_memory=True)
-    data_loader_img = DataLoader(data_set_img, batch_size=batch_size,
+    # optionally a fixed random subset of the sketch queries (the same every call), the gallery stays complete
+    query_set, query_labels = data_set_skt, data_set_skt.label_list
+    if num_queries is not None and num_queries < len(data_set_skt):
+        keep = np.sort(np.random.default_rng(0).choice(len(data_set_skt), num_queries, replace=False))
+        query_set, query_labels = Subset(data_set_skt, keep), data_set_skt.label_list[keep]
+
+    data_loader_skt = DataLoader(query_set, batch_size=batch_size,
                                  shuffle=False, num_workers=2, pin_memory=True)
 
     skt_model = skt_model.to(device)
@@ -386,73 +449,33 @@ def get_acc(skt_model, img_model, batch_size=128, dataset='ClothesV1', mode='tes
     skt_model.eval()
     img_model.eval()
 
-    top1_count = 0
-    top5_count = 0
-    top10_count = 0
-
     with torch.no_grad():
-        Image_Feature = torch.FloatTensor().to(device)
-        for imgs in tqdm(data_loader_img):
-            img = imgs.to(device)
-            img_feats, _ = img_model(img)
-            img_feats = F.normalize(img_feats, dim=1)
-            Image_Feature = torch.cat((Image_Feature, img_feats.detach()))
-
-        for idx, skts in enumerate(tqdm(data_loader_skt)):
-            skt, skt_idx = skts
-            skt, skt_idx = skt.to(device), skt_idx.to(device)
-            skt_feats, _ = skt_model(skt)
-            skt_feats = F.normalize(skt_feats, dim=1)
-
-            similarity_matrix = torch.argsort(torch.matmul(skt_feats, Image_Feature.T), dim=1, descending=True)
-
-            top1_count += (similarity_matrix[:, 0] == skt_idx).sum()
-            top5_count += (similarity_matrix[:, :5] == torch.unsqueeze(skt_idx, dim=1)).sum()
-            top10_count += (similarity_matrix[:, :10] == torch.unsqueeze(skt_idx, dim=1)).sum()
+        if sharded:
+            # every rank encodes a slice of the photos and sketches, the gallery is all-gathered
+            # and the top-k hits of the local sketches are summed over the ranks
+            Image_Feature = encode_sharded(img_model, data_set_img, batch_size=batch_size, device=device)
+            Sketch_Feature = encode_sharded(skt_model, query_set, batch_size=batch_size, device=device,
+                                            gather=False)
+            skt_idx = torch.tensor(query_labels[shard_slice(len(query_set))], device=device)
+
+            skt_rank = target_rank(Sketch_Feature, Image_Feature, skt_idx)
+            top1_accuracy, top5_accuracy, top10_accuracy = reduce_topk_accuracy(skt_rank, topk=(1, 5, 10))
+        else:
+            Image_Feature, _ = get_gallery_features(img_model, data_set_img, batch_size=batch_size,
+                                                    device=device, index_dir=index_dir)
+            Sketch_Feature = encode_features(skt_model, data_loader_skt, device=device)
+            skt_idx = torch.tensor(query_labels, device=device)
 
-        top1_accuracy = round(top1_count.item() / len(data_set_skt) * 100, 3)
-        top5_accuracy = round(top5_count.item() / len(data_set_skt) * 100, 3)
-        top10_accuracy = round(top10_count.item() / len(data_set_skt) * 100, 3)
+            skt_rank = target_rank(Sketch_Feature, Image_Feature, skt_idx)
+            top1_accuracy, top5_accuracy, top10_accuracy = topk_accuracy(skt_rank, topk=(1, 5, 10))
 
     return top1_accuracy, top5_accuracy, top10_accuracy
 
 
-#  InfoNCE Loss
-def cross_loss(feature_1, feature_2, args):
-    labels = torch.cat([torch.arange(len(feature_1)) for _ in range(args.n_views)], dim=0)
-    labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-    labels = labels.to(args.device)
-
-    # normalize
-    feature_1 = F.normalize(feature_1, dim=1)
-    feature_2 = F.normalize(feature_2, dim=1)
-    features = torch.cat((feature_1, feature_2), dim=0)  # (2*B, Feat_dim)
-
-    similarity_matrix = torch.matmul(features, features.T)  # (2*B, 2*B)
-
-    # discard the main diagonal from both: labels and similarities matrix
-    mask = torch.eye(labels.shape[0], dtype=torch.bool).to(args.device)
-    labels = labels[~mask].view(labels.shape[0], -1)
-    similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)  # (2*B, 2*B - 1)
-
-    # select and combine multiple positives
-    positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)  # (2*B, 1)
-
-    # select only the negatives the negatives
-    negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)  # (2*B, 2*(B - 1))
-
-    logits = torch.cat([positives, negatives], dim=1)
-    labels = torch.zeros(logits.shape[0], dtype=torch.long).to(args.device)
-
-    logits = logits / args.temperature
-
-    return nn.CrossEntropyLoss()(logits, labels)
-
-
 if __name__ == '__main__':
     device = torch.device('cuda:0')
     encoder = EncoderViT(num_classes=256, feature_dim=768,
-                         encoder_backbone='vit_base_patch16_224', device=device).to(device)
+                         encoder_backbone='vit_base_patch16_224').to(device)
     get_parameter_number(encoder)
     # Total params: 87,423,541
     # Trainable params: 87,423,541
@@ -5,28 +5,38 @@ Acknowledgements:
 """
 
 from torch import nn
+import numpy as np
 import torch
-from tqdm import tqdm
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
-from torchvision.transforms import Compose, Resize, ToTensor
+from torch.utils.data import DataLoader, Subset
 from data_loader import LoadDatasetSkt, LoadDatasetImg
+from image_cache import eval_transform
+from gallery_index import get_gallery_features
+from retrieval import encode_features, target_rank, topk_accuracy
+from distributed import encode_sharded, shard_slice, reduce_topk_accuracy
 
 
-def get_acc(skt_model, img_model, batch_size=128, dataset='ClothesV1', mode='test', device='cuda'):
+def get_acc(skt_model, img_model, batch_size=128, dataset='ClothesV1', mode='test', device='cuda',
+            index_dir=None, image_cache_dir=None, sharded=False, num_queries=None):
     print('Evaluating Network dataset [{}_{}] ...'.format(dataset, mode))
 
     data_set_skt = LoadDatasetSkt(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform(),
+                                  cache_dir=image_cache_dir)
 
     data_set_img = LoadDatasetImg(img_folder_path='./datasets/{}/{}B/'.format(dataset, mode),
                                   skt_folder_path='./datasets/{}/{}A/'.format(dataset, mode),
-                                  transform=Compose([Resize(224), ToTensor()]))
+                                  transform=eval_transform(),
+                                  cache_dir=image_cache_dir)
 
-    data_loader_skt = DataLoader(data_set_skt, batch_size=batch_size,
-                                 shuffle=True, num_workers=2, pin_memory=True)
-    data_loader_img = DataLoader(data_set_img, batch_size=batch_size,
+    # optionally a fixed random subset of the sketch queries (the same every call), the gallery stays complete
+    query_set, query_labels = data_set_skt, data_set_skt.label_list
+    if num_queries is not None and num_queries < len(data_set_skt):
+        keep = np.sort(np.random.default_rng(0).choice(len(data_set_skt), num_queries, replace=False))
+        query_set, query_labels = Subset(data_set_skt, keep), data_set_skt.label_list[keep]
+
+    data_loader_skt = DataLoader(query_set, batch_size=batch_size,
                                  shuffle=False, num_workers=2, pin_memory=True)
 
     skt_model = skt_model.to(device)
@@ -34,64 +44,73 @@ def get_acc(skt_model, img_model, batch_size=128, dataset='ClothesV1', mode='tes
     skt_model.eval()
     img_model.eval()
 
-    top1_count = 0
-    top5_count = 0
-    top10_count = 0
-
     with torch.no_grad():
-        Image_Feature = torch.FloatTensor().to(device)
-        for imgs in tqdm(data_loader_img):
-            img = imgs.to(device)
-            img_feats, _ = img_model(img)
-            img_feats = F.normalize(img_feats, dim=1)
-            Image_Feature = torch.cat((Image_Feature, img_feats.detach()))
-
-        for idx, skts in enumerate(tqdm(data_loader_skt)):
-            skt, skt_idx = skts
-            skt, skt_idx = skt.to(device), skt_idx.to(device)
-            skt_feats, _ = skt_model(skt)
-            skt_feats = F.normalize(skt_feats, dim=1)
+        if sharded:
+            # every rank encodes a slice of the photos and sketches, the gallery is all-gathered
+            # and the top-k hits of the local sketches are summed over the ranks
+            Image_Feature = encode_sharded(img_model, data_set_img, batch_size=batch_size, device=device)
+            Sketch_Feature = encode_sharded(skt_model, query_set, batch_size=batch_size, device=device,
+                                            gather=False)
+            skt_idx = torch.tensor(query_labels[shard_slice(len(query_set))], device=device)
+
+            skt_rank = target_rank(Sketch_Feature, Image_Feature, skt_idx)
+            top1_accuracy, top5_accuracy, top10_accuracy = reduce_topk_accuracy(skt_rank, topk=(1, 5, 10))
+        else:
+            Image_Feature, _ = get_gallery_features(img_model, data_set_img, batch_size=batch_size,
+                                                    device=device, index_dir=index_dir)
+            Sketch_Feature = encode_features(skt_model, data_loader_skt, device=device)
+            skt_idx = torch.tensor(query_labels, device=device)
+
+            skt_rank = target_rank(Sketch_Feature, Image_Feature, skt_idx)
+            top1_accuracy, top5_accuracy, top10_accuracy = topk_accuracy(skt_rank, topk=(1, 5, 10))
 
-            similarity_matrix = torch.argsort(torch.matmul(skt_feats, Image_Feature.T), dim=1, descending=True)
+    return top1_accuracy, top5_accuracy, top10_accuracy
 
-            top1_count += (similarity_matrix[:, 0] == skt_idx).sum()
-            top5_count += (similarity_matrix[:, :5] == torch.unsqueeze(skt_idx, dim=1)).sum()
-            top10_count += (similarity_matrix[:, :10] == torch.unsqueeze(skt_idx, dim=1)).sum()
 
-        top1_accuracy = round(top1_count.item() / len(data_set_skt) * 100, 3)
-        top5_accuracy = round(top5_count.item() / len(data_set_skt) * 100, 3)
-        top10_accuracy = round(top10_count.item() / len(data_set_skt) * 100, 3)
+# Fused views: one ViT pass per modality over [anchor; aug], or a single pass over all four views when
+# the sketch and image encoders are the same module, split back into per-view token features
+def embed_views(skt_model, img_model, skt_views, img_views):
+    if skt_model is img_model:
+        views = list(skt_views) + list(img_views)
+        feats = skt_model.embedding(torch.cat(views, dim=0)).split([len(view) for view in views])
+        return feats[:len(skt_views)], feats[len(skt_views):]
 
-    return top1_accuracy, top5_accuracy, top10_accuracy
+    skt_feats = skt_model.embedding(torch.cat(skt_views, dim=0)).split([len(view) for view in skt_views])
+    img_feats = img_model.embedding(torch.cat(img_views, dim=0)).split([len(view) for view in img_views])
+    return skt_feats, img_feats
 
 
 #  InfoNCE Loss
-def cross_loss(feature_1, feature_2, args):
-    labels = torch.cat([torch.arange(len(feature_1)) for _ in range(args.n_views)], dim=0)
-    labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-    labels = labels.to(args.device)
+# (2B, 2B) self-similarity mask and positive column ((i + B) mod 2B) per batch size and device
+INFO_NCE_TARGETS = {}
 
-    # normalize
-    feature_1 = F.normalize(feature_1, dim=1)
-    feature_2 = F.normalize(feature_2, dim=1)
-    features = torch.cat((feature_1, feature_2), dim=0)  # (2*B, Feat_dim)
 
-    similarity_matrix = torch.matmul(features, features.T)  # (2*B, 2*B)
+def info_nce_targets(batch_size, device):
+    key = (batch_size, str(device))
+    if key not in INFO_NCE_TARGETS:
+        mask = torch.eye(2 * batch_size, dtype=torch.bool, device=device)
+        labels = torch.arange(2 * batch_size, device=device).add_(batch_size).remainder_(2 * batch_size)
+        INFO_NCE_TARGETS[key] = mask, labels
+    return INFO_NCE_TARGETS[key]
 
-    # discard the main diagonal from both: labels and similarities matrix
-    mask = torch.eye(labels.shape[0], dtype=torch.bool).to(args.device)
-    labels = labels[~mask].view(labels.shape[0], -1)
-    similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)  # (2*B, 2*B - 1)
 
-    # select and combine multiple positives
-    positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)  # (2*B, 1)
+def multi_cross_loss(feature_pairs, args):
+    # normalize
+    similarity_matrix = []
+    for feature_1, feature_2 in feature_pairs:
+        features = F.normalize(torch.cat((feature_1, feature_2), dim=0), dim=1)  # (2*B, Feat_dim)
+        similarity_matrix.append(torch.matmul(features, features.T))  # (2*B, 2*B)
+    similarity_matrix = torch.stack(similarity_matrix)  # (L, 2*B, 2*B)
 
-    # select only the negatives the negatives
-    negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)  # (2*B, 2*(B - 1))
+    # drop the main diagonal with -inf instead of gathering positives / negatives into a new matrix,
+    # the cross entropy over the remaining 2*B - 1 columns is unchanged
+    mask, labels = info_nce_targets(len(feature_pairs[0][0]), similarity_matrix.device)
+    # logits and softmax in fp32, also when the similarities come out of an fp16 / bf16 autocast matmul
+    logits = similarity_matrix.float().masked_fill(mask, float('-inf')) / args.temperature
 
-    logits = torch.cat([positives, negatives], dim=1)
-    labels = torch.zeros(logits.shape[0], dtype=torch.long).to(args.device)
+    loss = F.cross_entropy(logits.transpose(1, 2), labels.expand(len(feature_pairs), -1), reduction='none')
+    return loss.mean(dim=1)  # (L,) one InfoNCE loss per pair
 
-    logits = logits / args.temperature
 
-    return nn.CrossEntropyLoss()(logits, labels)
+def cross_loss(feature_1, feature_2, args):
+    return multi_cross_loss([(feature_1, feature_2)], args)[0]
@@ -0,0 +1,46 @@
+import torch
+import torchvision.transforms.functional as TF
+
+from batch_augment import BatchAugment
+
+
+def smooth_images(batch_size=4, im_size=224):
+    # two blobs and a ramp, uint8 like the transform_uint8 anchors
+    yy, xx = torch.meshgrid(torch.linspace(-1, 1, im_size), torch.linspace(-1, 1, im_size), indexing='ij')
+    image = torch.stack([torch.exp(-((xx - 0.3) ** 2 + (yy + 0.2) ** 2) * 8),
+                         torch.exp(-((xx + 0.4) ** 2 + (yy - 0.1) ** 2) * 5),
+                         (xx + 1) / 2])
+    return (image * 255).round().to(torch.uint8).expand(batch_size, -1, -1, -1).contiguous()
+
+
+def test_augment_matches_transform_aug():
+    images = smooth_images()
+    batch_augment = BatchAugment(im_size=224)
+
+    # the angles / flips BatchAugment draws from the same seed
+    torch.manual_seed(0)
+    angles = (torch.rand(len(images)) * 2 - 1) * batch_augment.degrees
+    flips = torch.rand(len(images)) < batch_augment.flip_p
+    torch.manual_seed(0)
+    augmented = batch_augment.augment(images)
+
+    # LoadMyDataset.transform_aug with those angles / flips
+    expected = []
+    for image, angle, flip in zip(images, angles.tolist(), flips.tolist()):
+        image = TF.resize(image, [268, 268], antialias=True)
+        image = TF.rotate(image, angle)
+        image = TF.hflip(image) if flip else image
+        image = TF.center_crop(image, [224, 224])
+        expected.append(TF.convert_image_dtype(image, torch.float))
+    expected = torch.stack(expected)
+
+    # bilinear grid_sample vs nearest rotation, they differ only by interpolation
+    assert augmented.shape == expected.shape
+    assert (augmented - expected).abs().mean() < 5e-3
+
+
+def test_anchor_matches_transform_anchor():
+    images = smooth_images(im_size=256)
+    expected = torch.stack([TF.convert_image_dtype(TF.resize(image, [224, 224], antialias=True), torch.float)
+                            for image in images])
+    assert (BatchAugment(im_size=224).anchor(images) - expected).abs().max() < 2 / 255
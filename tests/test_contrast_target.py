@@ -0,0 +1,51 @@
+import torch
+
+from train_plus_utils import MultiScaleTransformer
+
+
+def original_target(matrix_len=249):
+    # the hard-coded scales [1, 2, 7] target of the original MultiScaleTransformer, loop for loop
+    identity_matrix = torch.eye(matrix_len)
+    matrix_10 = torch.zeros((49, 196))
+    for i in range(49):
+        matrix_10[i, i * 4:(i + 1) * 4] = 0.5
+    matrix_20 = torch.zeros((4, 245))
+    for i in range(4):
+        matrix_20[i, i * 49:(i + 1) * 49] = 0.5
+    for i in range(4):
+        if i != 3:
+            matrix_20[i, 196 + i * 12:196 + (i + 1) * 13] = 0.5
+        else:
+            matrix_20[i, 196 + i * 12:] = 0.5
+    matrix_01 = torch.zeros((196, 49))
+    for i in range(49):
+        matrix_01[i * 4:(i + 1) * 4, i] = 0.5
+    matrix_02 = torch.zeros((245, 4))
+    for i in range(4):
+        matrix_02[i * 49:(i + 1) * 49, i] = 0.5
+    for i in range(4):
+        if i != 3:
+            matrix_20[196 + i * 12:196 + (i + 1) * 13, i] = 0.5
+        else:
+            matrix_20[196 + i * 12:, i] = 0.5
+    identity_matrix[196:245, 0:196] = matrix_10
+    identity_matrix[245:249, 0:245] = matrix_20
+    identity_matrix[0:196, 196:245] = matrix_01
+    identity_matrix[0:245, 245:249] = matrix_02
+    return identity_matrix
+
+
+def test_default_target_is_the_original():
+    target = MultiScaleTransformer(input_dim=64, scales=[1, 2, 7], num_patches=196).contrast_target
+    assert target.dtype == torch.float32
+    assert torch.equal(target, original_target())
+
+
+def test_overlap_target_is_symmetric():
+    target = MultiScaleTransformer(input_dim=64, scales=[1, 2, 7], num_patches=196,
+                                   overlap_target=True).contrast_target
+    assert torch.equal(target, target.T)
+    # only the 7x7 / 2x2 block differs from the original
+    differs = (target != original_target()).nonzero()
+    assert len(differs) > 0
+    assert ((differs[:, 0] >= 196) & (differs[:, 1] >= 196)).all()
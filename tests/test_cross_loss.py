@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from train_utils import cross_loss, multi_cross_loss
+
+
+def original_cross_loss(feature_1, feature_2, args):
+    # the original single-pair InfoNCE, positives / negatives gathered into a new logits matrix
+    labels = torch.cat([torch.arange(len(feature_1)) for _ in range(args.n_views)], dim=0)
+    labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
+
+    feature_1 = F.normalize(feature_1, dim=1)
+    feature_2 = F.normalize(feature_2, dim=1)
+    features = torch.cat((feature_1, feature_2), dim=0)
+    similarity_matrix = torch.matmul(features, features.T)
+
+    mask = torch.eye(labels.shape[0], dtype=torch.bool)
+    labels = labels[~mask].view(labels.shape[0], -1)
+    similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
+    positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
+    negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
+
+    logits = torch.cat([positives, negatives], dim=1) / args.temperature
+    labels = torch.zeros(logits.shape[0], dtype=torch.long)
+    return nn.CrossEntropyLoss()(logits, labels)
+
+
+def test_multi_cross_loss_matches_per_pair_loop():
+    torch.manual_seed(0)
+    args = SimpleNamespace(temperature=0.07, n_views=2, device='cpu')
+    leaves = [torch.randn(8, 16, requires_grad=True) for _ in range(6)]
+    pairs = [(leaves[0], leaves[1]), (leaves[2], leaves[3]), (leaves[4], leaves[5]), (leaves[0], leaves[3])]
+
+    losses = multi_cross_loss(pairs, args)
+    grads = torch.autograd.grad(losses.sum(), leaves)
+    expected = torch.stack([original_cross_loss(feature_1, feature_2, args) for feature_1, feature_2 in pairs])
+    expected_grads = torch.autograd.grad(expected.sum(), leaves)
+
+    assert losses.shape == (len(pairs),)
+    torch.testing.assert_close(losses, expected)
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad)
+    torch.testing.assert_close(cross_loss(leaves[0], leaves[1], args), expected[0])
@@ -0,0 +1,61 @@
+import os
+import socket
+from types import SimpleNamespace
+import torch
+from torch import nn
+import torch.multiprocessing as mp
+
+from distributed import init_distributed, all_gather_features, wrap_ddp, cleanup_distributed
+from train_utils import multi_cross_loss
+
+WORLD_SIZE = 2
+
+
+def make_model():
+    torch.manual_seed(0)
+    return nn.Linear(6, 4)
+
+
+def encode(model, inputs):
+    return model(inputs[:, :6]), model(inputs[:, 6:])
+
+
+def run_rank(rank, port, inputs, result_path):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(WORLD_SIZE), LOCAL_RANK=str(rank),
+                      MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    args = SimpleNamespace(device='cpu', dist_backend='gloo', dist_timeout=1, temperature=0.1)
+    init_distributed(args)
+    model = make_model()
+    step_module = wrap_ddp(args, model=model)
+
+    # each rank encodes its own half, the InfoNCE negatives come from both halves
+    local = inputs.chunk(WORLD_SIZE)[rank]
+    skt_feat, img_feat = step_module(lambda x: encode(model, x), local)
+    loss = multi_cross_loss([(all_gather_features(skt_feat), all_gather_features(img_feat))], args).sum()
+    loss.backward()
+    torch.save({'loss': loss.detach(), 'grads': [param.grad for param in model.parameters()]},
+               '{}_{}.pt'.format(result_path, rank))
+    cleanup_distributed()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_all_gather_matches_single_process(tmp_path):
+    torch.manual_seed(1)
+    inputs = torch.randn(8, 12)
+
+    model = make_model()
+    loss = multi_cross_loss([encode(model, inputs)], SimpleNamespace(temperature=0.1)).sum()
+    loss.backward()
+
+    result_path = str(tmp_path / 'rank')
+    mp.spawn(run_rank, args=(free_port(), inputs, result_path), nprocs=WORLD_SIZE)
+    for rank in range(WORLD_SIZE):
+        result = torch.load('{}_{}.pt'.format(result_path, rank))
+        torch.testing.assert_close(result['loss'], loss.detach())
+        for grad, param in zip(result['grads'], model.parameters()):
+            torch.testing.assert_close(grad, param.grad)